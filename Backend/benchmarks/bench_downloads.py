@@ -0,0 +1,166 @@
+# benchmarks/bench_downloads.py
+"""
+What concurrent large downloads cost one worker, per DOWNLOAD_MODE.
+
+Run from the Backend directory (needs httpx):
+    python benchmarks/bench_downloads.py [concurrency] [size_mb]
+
+For each mode a single uvicorn worker is started on a throwaway SQLite
+database and upload directory, one attachment is uploaded, and `concurrency`
+clients download it at once while a probe keeps requesting / to see how
+long other requests wait behind the downloads.
+
+In the offload modes the worker only answers with the redirect header; the
+bytes would come from nginx / Apache, which is the point, so only the
+worker's side is measured there.
+"""
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sniffing import ENCRYPTED_ENVELOPE_PREFIX  # noqa: E402
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+MODES = ["app", "x-accel-redirect", "x-sendfile"]
+CONCURRENCY = 32
+SIZE_MB = 48  # uploads are capped at 50 MB
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float:
+    """utime + stime of a process (Linux /proc), or nan elsewhere."""
+    try:
+        fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    except OSError:
+        return float("nan")
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def start_worker(mode: str, workdir: str, port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{workdir}/bench.db",
+        "UPLOAD_DIR": f"{workdir}/uploads",
+        "DOWNLOAD_MODE": mode,
+        "USER_STORAGE_QUOTA_MB": "0",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient):
+    for _ in range(200):
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("worker did not start")
+
+
+async def setup(client: httpx.AsyncClient, size_mb: int) -> tuple[dict, int]:
+    tokens = {}
+    for username in ("alice", "bob"):
+        await client.post("/register", json={
+            "username": username, "password": "pw", "identity_public_key": "k", "prekey_public": "p",
+        })
+        r = await client.post("/login", json={"username": username, "password": "pw"})
+        tokens[username] = {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+    r = await client.post(
+        "/upload-file",
+        headers=tokens["alice"],
+        data={"to_username": "bob"},
+        files={"file": ("video.mp4", ENCRYPTED_ENVELOPE_PREFIX + os.urandom(size_mb * 1024 * 1024), "video/mp4")},
+    )
+    r.raise_for_status()
+    return tokens["bob"], r.json()["file_id"]
+
+
+async def download(client: httpx.AsyncClient, headers: dict, file_id: int) -> int:
+    received = 0
+    async with client.stream("GET", f"/download-file/{file_id}", headers=headers) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_raw():
+            received += len(chunk)
+    return received
+
+
+async def probe(client: httpx.AsyncClient, stop: asyncio.Event, latencies: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get("/")
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.01)
+
+
+async def run_mode(mode: str, concurrency: int, size_mb: int) -> dict:
+    workdir = tempfile.mkdtemp()
+    port = free_port()
+    worker = start_worker(mode, workdir, port)
+    limits = httpx.Limits(max_connections=concurrency + 2)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=300, limits=limits) as client:
+            await wait_ready(client)
+            headers, file_id = await setup(client, size_mb)
+
+            latencies = []
+            stop = asyncio.Event()
+            probe_task = asyncio.create_task(probe(client, stop, latencies))
+            cpu_before = cpu_seconds(worker.pid)
+            start = time.perf_counter()
+            sizes = await asyncio.gather(*(download(client, headers, file_id) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            cpu = cpu_seconds(worker.pid) - cpu_before
+            stop.set()
+            await probe_task
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "served_mb": sum(sizes) / 1024 / 1024,
+        "cpu": cpu,
+        "p50": statistics.median(latencies) if latencies else float("nan"),
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else float("nan"),
+    }
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else CONCURRENCY
+    size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else SIZE_MB
+
+    print(f"{concurrency} concurrent downloads of a {size_mb} MB file, one worker")
+    print(f"{'mode':>18} {'wall s':>8} {'worker MB':>10} {'worker cpu s':>13} {'/ p50 ms':>9} {'/ p99 ms':>9}")
+    for mode in MODES:
+        r = asyncio.run(run_mode(mode, concurrency, size_mb))
+        print(
+            f"{mode:>18} {r['elapsed']:>8.2f} {r['served_mb']:>10.0f} {r['cpu']:>13.2f} "
+            f"{r['p50']:>9.1f} {r['p99']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
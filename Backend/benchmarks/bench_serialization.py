@@ -0,0 +1,178 @@
+# benchmarks/bench_serialization.py
+"""
+CPU spent serializing history pages and fanned-out /ws frames.
+
+Run from the Backend directory:
+    python benchmarks/bench_serialization.py
+
+History: a 100-message page from a throwaway SQLite database, built the old
+way (ORM objects, isoformat() per row, jsonable_encoder, stdlib JSONResponse)
+and the current way (column rows straight into FastJSONResponse).
+
+Frames: 10k group_message frames, encoded once per recipient socket with the
+stdlib json / msgpack, versus one shared wire.Frame plus a spliced-in key
+per recipient.
+"""
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+_workdir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{_workdir}/bench.db"
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import ciphertext as ct  # noqa: E402
+import fastjson  # noqa: E402
+import models  # noqa: E402
+import wire  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+from fastjson import FastJSONResponse  # noqa: E402
+
+PAGE_SIZE = 100
+PAGE_ITERATIONS = 500
+FRAMES = 10_000
+
+
+def b64(n: int) -> str:
+    return base64.b64encode(os.urandom(n)).decode("ascii")
+
+
+def envelope(plaintext_size: int = 256) -> str:
+    return json.dumps(
+        {"v": 1, "nonce": b64(24), "box": b64(plaintext_size + 16), "from_pub": b64(32)},
+        separators=(",", ":"),
+    )
+
+
+def seed() -> tuple[int, int]:
+    Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        alice = models.User(username="alice", password_hash="x", identity_public_key="a", prekey_public="a")
+        bob = models.User(username="bob", password_hash="x", identity_public_key="b", prekey_public="b")
+        db.add_all([alice, bob])
+        db.flush()
+        for i in range(PAGE_SIZE):
+            sender, recipient = (alice, bob) if i % 2 else (bob, alice)
+            db.add(models.Message(
+                from_user_id=sender.id,
+                to_user_id=recipient.id,
+                ciphertext=ct.pack(envelope()),
+            ))
+        db.commit()
+        return alice.id, bob.id
+
+
+def page_orm(db) -> bytes:
+    msgs = db.query(models.Message).order_by(models.Message.created_at.desc()).limit(PAGE_SIZE).all()
+    content = [
+        {
+            "id": m.id,
+            "from_user_id": m.from_user_id,
+            "to_user_id": m.to_user_id,
+            "ciphertext": ct.unpack(m.ciphertext),
+            "created_at": m.created_at.isoformat() if m.created_at else None,
+        }
+        for m in msgs
+    ]
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def page_rows(db) -> bytes:
+    rows = (
+        db.query(
+            models.Message.id,
+            models.Message.from_user_id,
+            models.Message.to_user_id,
+            models.Message.ciphertext,
+            models.Message.created_at,
+        )
+        .order_by(models.Message.created_at.desc())
+        .limit(PAGE_SIZE)
+        .all()
+    )
+    return FastJSONResponse([
+        {
+            "id": msg_id,
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "ciphertext": ct.unpack(ciphertext),
+            "created_at": created_at,
+        }
+        for msg_id, from_user_id, to_user_id, ciphertext, created_at in rows
+    ]).body
+
+
+def timed(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_history():
+    seed()
+    with SessionLocal() as db:
+        old, new = page_orm(db), page_rows(db)
+        assert json.loads(old) == json.loads(new), "history pages differ"
+
+        orm = timed(lambda: (page_orm(db), db.expunge_all()), PAGE_ITERATIONS)
+        rows = timed(lambda: page_rows(db), PAGE_ITERATIONS)
+
+    print(f"history page ({PAGE_SIZE} messages, {len(new)} bytes)")
+    print(f"  {'ORM + jsonable_encoder + json':<34} {orm * 1000:>8.3f} ms")
+    print(f"  {'rows + ' + ('orjson' if fastjson.orjson else 'json'):<34} {rows * 1000:>8.3f} ms  ({orm / rows:.1f}x)")
+
+
+def bench_frames():
+    body = {
+        "type": "group_message",
+        "id": 123456,
+        "group_id": 42,
+        "from": "alice",
+        "ciphertext": ct.pack(envelope()),
+        "created_at": "2026-01-12T15:30:00.123456",
+    }
+    keys = [b64(72) for _ in range(FRAMES)]
+
+    def stdlib_json():
+        unpacked = {**body, "ciphertext": ct.unpack(body["ciphertext"])}
+        for key in keys:
+            json.dumps({**unpacked, "key": key})
+
+    def per_socket(codec):
+        for key in keys:
+            codec.encode({**body, "key": key})
+
+    def shared(codec):
+        frame = wire.Frame(body)
+        for key in keys:
+            frame.with_fields(key=key).encode(codec)
+
+    codecs = [wire.JSON_CODEC]
+    if wire.MSGPACK_CODEC is not None:
+        codecs.append(wire.MSGPACK_CODEC)
+
+    print(f"{FRAMES} group_message frames")
+    print(f"  {'stdlib json, per socket':<34} {timed(stdlib_json, 1) * 1000:>8.1f} ms")
+    for codec in codecs:
+        print(f"  {codec.subprotocol + ', per socket':<34} {timed(lambda: per_socket(codec), 1) * 1000:>8.1f} ms")
+        print(f"  {codec.subprotocol + ', shared Frame':<34} {timed(lambda: shared(codec), 1) * 1000:>8.1f} ms")
+
+
+def main():
+    if fastjson.orjson is None:
+        print("orjson not installed, fastjson falls back to the stdlib json")
+    bench_history()
+    bench_frames()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# benchmarks/bench_startup.py
+"""
+Worker startup time: importing main, and running the app's startup hooks.
+
+Run from the Backend directory against the configured DATABASE_URL:
+    python benchmarks/bench_startup.py [backend_dir]
+
+Each sample is a fresh interpreter, like a newly spawned uvicorn worker.
+Pass another checkout's Backend directory to compare before/after.
+"""
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+RUNS = 5
+
+PROBE = """
+import asyncio, sys, time
+sys.path.insert(0, ".")
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def startup():
+    async with main.app.router.lifespan_context(main.app):
+        pass
+
+asyncio.run(startup())
+ready = time.perf_counter()
+print(f"STARTUP_MS {(imported - start) * 1000:.1f} {(ready - start) * 1000:.1f}")
+"""
+
+
+def main():
+    backend_dir = Path(sys.argv[1] if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent)
+
+    imports, readies = [], []
+    for _ in range(RUNS):
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE],
+            cwd=backend_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        line = next(l for l in result.stdout.splitlines() if l.startswith("STARTUP_MS"))
+        imported_ms, ready_ms = line.split()[1:]
+        imports.append(float(imported_ms))
+        readies.append(float(ready_ms))
+
+    print(f"{backend_dir}")
+    print(f"  import main:        median {statistics.median(imports):8.1f} ms")
+    print(f"  import + startup:   median {statistics.median(readies):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# benchmarks/bench_upload_sniff.py
+"""
+Cost of magic-byte validation per upload.
+
+Run from the Backend directory (needs python-magic / libmagic):
+    python benchmarks/bench_upload_sniff.py
+
+Compares the old approach (a new magic.Magic handle per upload) with the
+cached per-thread handle, then measures what sniffing adds to writing an
+upload to disk when it runs in the pool while the file is being written.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sniffing  # noqa: E402
+
+ITERATIONS = 200
+UPLOAD_SIZES = [64 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+PNG_HEADER = b"\x89PNG\r\n\x1a\n" + b"\0\0\0\rIHDR" + os.urandom(2048)
+
+
+def per_call(fn) -> float:
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fn()
+    return (time.perf_counter() - start) / ITERATIONS * 1000
+
+
+def new_handle_each_time():
+    return sniffing.magic.Magic(mime=True).from_buffer(PNG_HEADER[:sniffing.SNIFF_BYTES])
+
+
+def cached_handle():
+    return sniffing.sniff_content(PNG_HEADER[:sniffing.SNIFF_BYTES], ".png")
+
+
+async def write_upload(data: bytes, sniff: bool) -> float:
+    source = tempfile.SpooledTemporaryFile()
+    source.write(data)
+    source.seek(0)
+    fd, target = tempfile.mkstemp()
+    os.close(fd)
+
+    start = time.perf_counter()
+    header = source.read(sniffing.SNIFF_BYTES)
+    if sniff:
+        pending = asyncio.get_running_loop().run_in_executor(
+            sniffing.sniff_executor, sniffing.sniff_content, header, ".png"
+        )
+    with open(target, "wb") as buffer:
+        buffer.write(header)
+        await asyncio.to_thread(shutil.copyfileobj, source, buffer, 1024 * 1024)
+    if sniff:
+        await pending
+    elapsed = (time.perf_counter() - start) * 1000
+
+    os.remove(target)
+    return elapsed
+
+
+async def upload_latency():
+    print(f"\n{'upload':>10} {'write ms':>10} {'write+sniff ms':>16} {'added ms':>10}")
+    for size in UPLOAD_SIZES:
+        data = PNG_HEADER + os.urandom(size - len(PNG_HEADER))
+        # warm up the pool thread's handle
+        await write_upload(data, sniff=True)
+        plain = min([await write_upload(data, sniff=False) for _ in range(10)])
+        sniffed = min([await write_upload(data, sniff=True) for _ in range(10)])
+        print(f"{size // 1024:>8}KB {plain:>10.2f} {sniffed:>16.2f} {sniffed - plain:>10.2f}")
+
+
+def main():
+    if sniffing.magic is None:
+        print("python-magic not installed, nothing to benchmark")
+        return
+
+    cached_handle()  # warm up
+    print(f"new magic.Magic per upload: {per_call(new_handle_each_time):8.3f} ms")
+    print(f"cached handle:              {per_call(cached_handle):8.3f} ms")
+    asyncio.run(upload_latency())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# benchmarks/bench_ws_framing.py
+"""
+Bytes on the wire and CPU per frame for the /ws encodings.
+
+Run from the Backend directory:
+    python benchmarks/bench_ws_framing.py
+
+For each plaintext size a realistic "message" frame is built (v1 envelope
+with random nonce/box/from_pub, like the web and mobile clients produce),
+then encoded and decoded with both codecs. The deflate column is the same
+frame run through raw deflate, which is what permessage-deflate does.
+"""
+import base64
+import json
+import os
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ciphertext as ct  # noqa: E402
+import wire  # noqa: E402
+
+SIZES = [16, 256, 4096, 65536]
+ITERATIONS = 5000
+
+
+def make_frame(plaintext_size: int) -> dict:
+    b64 = lambda n: base64.b64encode(os.urandom(n)).decode("ascii")
+    ciphertext = json.dumps(
+        {"v": 1, "nonce": b64(24), "box": b64(plaintext_size + 16), "from_pub": b64(32)},
+        separators=(",", ":"),
+    )
+    # Ciphertext is held packed inside the server, as stored in the DB
+    return {
+        "type": "message",
+        "id": 123456,
+        "from": "alice",
+        "ciphertext": ct.pack(ciphertext),
+        "created_at": "2026-01-12T15:30:00.123456",
+    }
+
+
+def deflated_size(data) -> int:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    compressor = zlib.compressobj(wbits=-15)
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+def bench(codec, frame: dict) -> tuple[int, int, float, float]:
+    encoded = codec.encode(frame)
+    size = len(encoded.encode("utf-8")) if isinstance(encoded, str) else len(encoded)
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        codec.encode(frame)
+    encode_us = (time.perf_counter() - start) / ITERATIONS * 1e6
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        codec.decode(encoded)
+    decode_us = (time.perf_counter() - start) / ITERATIONS * 1e6
+
+    return size, deflated_size(encoded), encode_us, decode_us
+
+
+def main():
+    codecs = [wire.JSON_CODEC]
+    if wire.MSGPACK_CODEC is not None:
+        codecs.append(wire.MSGPACK_CODEC)
+    else:
+        print("msgpack not installed, only benchmarking JSON framing")
+
+    print(f"{'plaintext':>10} {'encoding':>18} {'bytes':>8} {'deflate':>8} {'enc us':>8} {'dec us':>8}")
+    for plaintext_size in SIZES:
+        frame = make_frame(plaintext_size)
+        for codec in codecs:
+            size, deflated, enc, dec = bench(codec, frame)
+            print(f"{plaintext_size:>10} {codec.subprotocol:>18} {size:>8} {deflated:>8} {enc:>8.2f} {dec:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# ciphertext.py
+"""
+Compact binary form of the ciphertext strings produced by the clients.
+
+Web and mobile clients send one of two text formats:
+- v1 envelope: JSON.stringify({v: 1, nonce, box, from_pub}) with base64 fields
+- legacy: base64(nonce + box)
+
+Base64 inflates every byte by a third, so the server stores ciphertext (and
+sends it over binary WebSocket framing) packed into:
+
+    0x01 | nonce (24) | from_pub (32) | box     -> v1 envelope
+    0x02 | raw bytes                            -> legacy base64 blob
+    0x00 | utf-8 text                           -> anything else, verbatim
+
+Packing is lossless: a compact form is only used if unpacking it gives back
+the exact original string, so clients always see what the sender sent. That
+round-trip check also rejects non-canonical base64, so decoding is not run
+in the (much slower) validating mode.
+"""
+import base64
+import binascii
+import json
+
+TAG_TEXT = 0x00
+TAG_ENVELOPE_V1 = 0x01
+TAG_LEGACY = 0x02
+
+NONCE_SIZE = 24
+PUBLIC_KEY_SIZE = 32
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def _pack_envelope(text: str) -> bytes | None:
+    if not text.startswith('{"v":1,'):
+        return None
+    try:
+        obj = json.loads(text)
+        nonce = base64.b64decode(obj["nonce"])
+        box = base64.b64decode(obj["box"])
+        from_pub = base64.b64decode(obj["from_pub"])
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        return None
+
+    if len(nonce) != NONCE_SIZE or len(from_pub) != PUBLIC_KEY_SIZE:
+        return None
+
+    packed = bytes([TAG_ENVELOPE_V1]) + nonce + from_pub + box
+    return packed if unpack(packed) == text else None
+
+
+def _pack_legacy(text: str) -> bytes | None:
+    try:
+        raw = base64.b64decode(text)
+    except (ValueError, binascii.Error):
+        return None
+
+    return bytes([TAG_LEGACY]) + raw if _b64(raw) == text else None
+
+
+def pack(text: str) -> bytes:
+    """Pack a client ciphertext string into its compact binary form."""
+    packed = _pack_envelope(text) or _pack_legacy(text)
+    if packed is not None:
+        return packed
+    return bytes([TAG_TEXT]) + text.encode("utf-8")
+
+
+def unpack(data: bytes) -> str:
+    """Turn packed ciphertext back into the exact string the client sent."""
+    if not data:
+        raise ValueError("Empty ciphertext")
+
+    tag, body = data[0], bytes(data[1:])
+
+    if tag == TAG_ENVELOPE_V1:
+        if len(body) < NONCE_SIZE + PUBLIC_KEY_SIZE:
+            raise ValueError("Truncated ciphertext envelope")
+        nonce = body[:NONCE_SIZE]
+        from_pub = body[NONCE_SIZE:NONCE_SIZE + PUBLIC_KEY_SIZE]
+        box = body[NONCE_SIZE + PUBLIC_KEY_SIZE:]
+        # Same key order and separators as JSON.stringify on the clients;
+        # base64 never needs JSON escaping so the string is built directly
+        return (
+            f'{{"v":1,"nonce":"{_b64(nonce)}","box":"{_b64(box)}",'
+            f'"from_pub":"{_b64(from_pub)}"}}'
+        )
+
+    if tag == TAG_LEGACY:
+        return _b64(body)
+
+    if tag == TAG_TEXT:
+        return body.decode("utf-8")
+
+    raise ValueError(f"Unknown ciphertext tag: {tag}")
+
+
+def check(data: bytes) -> bytes:
+    """Validate packed ciphertext received from a client without unpacking it."""
+    if not data:
+        raise ValueError("Empty ciphertext")
+
+    tag = data[0]
+    if tag == TAG_ENVELOPE_V1:
+        if len(data) < 1 + NONCE_SIZE + PUBLIC_KEY_SIZE:
+            raise ValueError("Truncated ciphertext envelope")
+    elif tag == TAG_TEXT:
+        bytes(data[1:]).decode("utf-8")
+    elif tag != TAG_LEGACY:
+        raise ValueError(f"Unknown ciphertext tag: {tag}")
+    return bytes(data)
@@ -1,17 +1,237 @@
 # database.py
+import itertools
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL not set. Check your .env file.")
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-)
+# Pool tuning (all optional, see README "Configuration")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, -1 disables
+# pre_ping costs a round-trip per checkout; pool_recycle already retires
+# connections before the server's idle timeout, so it is off by default.
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 = no limit
+
+# Optional read replicas (comma-separated URLs), see read_session()
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+# After a user's own write, their reads stay on the primary this long
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+
+class PoolMetrics:
+    """Checkout wait / hold times for the connection pool, for sizing it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.checkins = 0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+
+    def record_hold(self, seconds: float):
+        with self._lock:
+            self.checkins += 1
+            self.hold_total += seconds
+            self.hold_max = max(self.hold_max, seconds)
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            stats = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": self.wait_total / self.waits * 1000 if self.waits else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+                "hold_avg_ms": self.hold_total / self.checkins * 1000 if self.checkins else 0.0,
+                "hold_max_ms": self.hold_max * 1000,
+            }
+        stats.update(self.occupancy(pool))
+        return stats
+
+    @staticmethod
+    def occupancy(pool) -> dict:
+        if not isinstance(pool, QueuePool):
+            return {}
+        return {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "idle": pool.checkedin(),
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return conn
+
+
+def _engine_kwargs(url) -> dict:
+    kwargs = {
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    backend = url.get_backend_name()
+
+    # SQLite (local dev) keeps SQLAlchemy's default pool
+    if backend != "sqlite":
+        kwargs.update(
+            poolclass=TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+
+    if DB_STATEMENT_TIMEOUT_MS and backend == "postgresql":
+        kwargs["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+
+    return kwargs
+
+
+def _create_engine(url: str):
+    """Engine with the pool settings above, instrumented for pool_metrics."""
+    parsed = make_url(url)
+    new_engine = create_engine(url, **_engine_kwargs(parsed))
+
+    if DB_STATEMENT_TIMEOUT_MS and parsed.get_backend_name() == "mysql":
+        @event.listens_for(new_engine, "connect")
+        def _set_mysql_statement_timeout(dbapi_conn, connection_record):
+            cursor = dbapi_conn.cursor()
+            cursor.execute(f"SET SESSION max_execution_time = {DB_STATEMENT_TIMEOUT_MS}")
+            cursor.close()
+
+    @event.listens_for(new_engine, "checkout")
+    def _on_checkout(dbapi_conn, connection_record, connection_proxy):
+        pool_metrics.record_checkout()
+        connection_record.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(new_engine, "checkin")
+    def _on_checkin(dbapi_conn, connection_record):
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is not None:
+            pool_metrics.record_hold(time.perf_counter() - started)
+
+    return new_engine
+
+
+engine = _create_engine(DATABASE_URL)
+replica_engines = [_create_engine(url) for url in DATABASE_REPLICA_URLS]
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+
+
+# ----------------- READ REPLICAS ----------------- #
+
+class RecentWriters:
+    """
+    Users who wrote something in the last READ_YOUR_WRITES_SECONDS, so their
+    reads skip replicas that may not have caught up yet. Per process: with
+    several workers, a read served by another worker is only protected if
+    the load balancer keeps a client on one worker.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+        self._until = {}
+
+    def note(self, user_id: int):
+        now = time.monotonic()
+        with self._lock:
+            self._until[user_id] = now + self.window
+            if len(self._until) > 10000:
+                self._until = {u: t for u, t in self._until.items() if t > now}
+
+    def is_recent(self, user_id: int) -> bool:
+        with self._lock:
+            return self._until.get(user_id, 0) > time.monotonic()
+
+
+recent_writers = RecentWriters(READ_YOUR_WRITES_SECONDS)
+
+
+# Sessions that know their user (session.info["user_id"]) report it to
+# recent_writers when they commit a write
+@event.listens_for(SessionLocal, "after_flush")
+def _flushed_write(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _bulk_write(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _note_writer(session):
+    if session.info.pop("wrote", False) and session.info.get("user_id") is not None:
+        recent_writers.note(session.info["user_id"])
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _forget_write(session):
+    session.info.pop("wrote", None)
+
+
+ReplicaSessionLocals = [
+    sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+    for replica_engine in replica_engines
+]
+_replica_cycle = itertools.cycle(ReplicaSessionLocals)
+
+for _replica_session in ReplicaSessionLocals:
+    @event.listens_for(_replica_session, "before_flush")
+    def _read_only(session, flush_context, instances):
+        raise RuntimeError("Replica sessions are read-only; use SessionLocal for writes")
+
+
+def read_session(user_id: Optional[int] = None) -> Session:
+    """
+    A session for read-only work: a replica (round-robin) when configured,
+    unless user_id wrote recently, then the primary.
+    """
+    if not ReplicaSessionLocals or (user_id is not None and recent_writers.is_recent(user_id)):
+        return SessionLocal(info={"user_id": user_id})
+    return next(_replica_cycle)()
@@ -0,0 +1,131 @@
+# export.py
+"""
+Full conversation export for GET /export/{username}.
+
+Every message, then every file message, between two users is streamed as
+NDJSON through a server-side cursor (yield_per), so memory stays flat
+however long the history is. Each line carries a cursor; passing the last
+one received back as ?cursor= resumes right after it. The last line is
+{"type": "end", "cursor": ...}.
+
+One-to-one conversations only; a group's history is paged through
+GET /groups/{id}/messages?after_id=.
+"""
+from typing import Iterator, Tuple
+
+import ciphertext as ct
+import fastjson
+import models
+import tombstones
+from database import SessionLocal
+
+MESSAGE = "message"
+FILE_MESSAGE = "file_message"
+SECTIONS = (MESSAGE, FILE_MESSAGE)
+
+# Rows fetched per round-trip, and lines per chunk handed to the response
+EXPORT_BATCH_SIZE = 1000
+
+
+def parse_cursor(cursor: str | None) -> Tuple[str, int]:
+    """'message:123' -> ('message', 123). Raises ValueError if malformed."""
+    if not cursor:
+        return MESSAGE, 0
+    section, _, last_id = cursor.partition(":")
+    if section not in SECTIONS:
+        raise ValueError(f"Unknown cursor section {section!r}")
+    return section, int(last_id)
+
+
+def _messages(db, user_id: int, other_id: int, after_id: int, usernames: dict) -> Iterator[dict]:
+    watermark, _ = tombstones.watermarks(db, user_id, other_id)
+    rows = (
+        db.query(
+            models.Message.id,
+            models.Message.from_user_id,
+            models.Message.to_user_id,
+            models.Message.ciphertext,
+            models.Message.created_at,
+            models.Message.delivered,
+        )
+        .filter(
+            tombstones.pair_filter(models.Message, user_id, other_id),
+            models.Message.id > max(after_id, watermark),
+        )
+        .order_by(models.Message.id)
+        .yield_per(EXPORT_BATCH_SIZE)
+    )
+    for msg_id, from_user_id, to_user_id, ciphertext, created_at, delivered in rows:
+        yield {
+            "type": MESSAGE,
+            "cursor": f"{MESSAGE}:{msg_id}",
+            "id": msg_id,
+            "from": usernames[from_user_id],
+            "to": usernames[to_user_id],
+            "ciphertext": ct.unpack(ciphertext),
+            "created_at": created_at,
+            "delivered": delivered,
+        }
+
+
+def _file_messages(db, user_id: int, other_id: int, after_id: int, usernames: dict) -> Iterator[dict]:
+    _, watermark = tombstones.watermarks(db, user_id, other_id)
+    rows = (
+        db.query(
+            models.FileMessage.id,
+            models.FileMessage.from_user_id,
+            models.FileMessage.to_user_id,
+            models.FileMessage.filename,
+            models.FileMessage.file_size,
+            models.FileMessage.file_type,
+            models.FileMessage.created_at,
+        )
+        .filter(
+            tombstones.pair_filter(models.FileMessage, user_id, other_id),
+            models.FileMessage.id > max(after_id, watermark),
+        )
+        .order_by(models.FileMessage.id)
+        .yield_per(EXPORT_BATCH_SIZE)
+    )
+    for file_id, from_user_id, to_user_id, filename, file_size, file_type, created_at in rows:
+        yield {
+            "type": FILE_MESSAGE,
+            "cursor": f"{FILE_MESSAGE}:{file_id}",
+            "id": file_id,
+            "file_id": file_id,
+            "from": usernames[from_user_id],
+            "to": usernames[to_user_id],
+            "filename": filename,
+            "file_size": file_size,
+            "file_type": file_type,
+            "created_at": created_at,
+        }
+
+
+def stream_conversation(user_id: int, other_id: int, usernames: dict, cursor: Tuple[str, int]) -> Iterator[str]:
+    """
+    NDJSON for the whole conversation after `cursor` (from parse_cursor),
+    yielded in chunks of EXPORT_BATCH_SIZE lines so the response isn't
+    handed one row at a time to the event loop. usernames maps both ids.
+    """
+    section, after_id = cursor
+    last_cursor = f"{section}:{after_id}" if after_id else None
+
+    with SessionLocal() as db:
+        sources = []
+        if section == MESSAGE:
+            sources.append(_messages(db, user_id, other_id, after_id, usernames))
+            after_id = 0
+        sources.append(_file_messages(db, user_id, other_id, after_id, usernames))
+
+        lines = []
+        for source in sources:
+            for item in source:
+                lines.append(fastjson.dumps_str(item) + "\n")
+                last_cursor = item["cursor"]
+                if len(lines) >= EXPORT_BATCH_SIZE:
+                    yield "".join(lines)
+                    lines = []
+
+    lines.append(fastjson.dumps_str({"type": "end", "cursor": last_cursor}) + "\n")
+    yield "".join(lines)
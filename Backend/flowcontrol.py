@@ -0,0 +1,187 @@
+# flowcontrol.py
+"""
+Inbound flow control for /ws.
+
+Every frame a client sends costs one token from its connection's bucket
+(WS_RATE_PER_SECOND refill, WS_RATE_BURST capacity). An empty bucket
+doesn't reject the frame, it delays reading the next one, so a client
+pushing too fast is slowed down by TCP backpressure instead of getting
+errors for messages it already sent.
+
+Frames over WS_MAX_FRAME_BYTES are refused before they are decoded (see
+wire.Connection.receive). That happens after uvicorn has read the whole
+frame, which it caps at --ws-max-size (16 MiB unless set), so run uvicorn
+with --ws-max-size a little above WS_MAX_FRAME_BYTES.
+
+Handling a frame takes a turn from the worker-wide scheduler: at most
+WS_MAX_CONCURRENT_FRAMES frames in flight, and waiting connections are
+served first come, first served. A connection only ever has one frame
+waiting, so that is round robin across connections: a flooding client gets
+one frame handled per round, like everyone else. Handlers give the slot
+back (Slot.release) once the message is stored, before sending to
+recipients, so slow recipient sockets don't hold slots.
+
+Throttling shows up in GET /debug/ws-flow.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(256 * 1024)))
+WS_RATE_PER_SECOND = float(os.getenv("WS_RATE_PER_SECOND", "20"))
+WS_RATE_BURST = int(os.getenv("WS_RATE_BURST", "40"))
+WS_MAX_CONCURRENT_FRAMES = int(os.getenv("WS_MAX_CONCURRENT_FRAMES", "16"))
+
+
+class FlowMetrics:
+    """Counters for /debug/ws-flow."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.oversized = 0
+        self.throttled = 0
+        self.throttle_total = 0.0
+        self.throttle_max = 0.0
+        self.queued = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def record_frame(self):
+        with self._lock:
+            self.frames += 1
+
+    def record_oversized(self):
+        with self._lock:
+            self.oversized += 1
+
+    def record_throttle(self, seconds: float):
+        with self._lock:
+            self.throttled += 1
+            self.throttle_total += seconds
+            self.throttle_max = max(self.throttle_max, seconds)
+
+    def record_queue_wait(self, seconds: float):
+        with self._lock:
+            self.queued += 1
+            self.queue_wait_total += seconds
+            self.queue_wait_max = max(self.queue_wait_max, seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "oversized_frames": self.oversized,
+                "throttled_frames": self.throttled,
+                "throttle_avg_ms": self.throttle_total / self.throttled * 1000 if self.throttled else 0.0,
+                "throttle_max_ms": self.throttle_max * 1000,
+                "queued_frames": self.queued,
+                "queue_wait_avg_ms": self.queue_wait_total / self.queued * 1000 if self.queued else 0.0,
+                "queue_wait_max_ms": self.queue_wait_max * 1000,
+            }
+
+
+flow_metrics = FlowMetrics()
+
+
+class TokenBucket:
+    """One connection's allowance of frames."""
+
+    def __init__(self, rate: float = WS_RATE_PER_SECOND, burst: int = WS_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Spend a token; returns how long to wait before using it (0 if none)."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+async def throttle(bucket: TokenBucket):
+    """Wait until the connection may have its next frame handled."""
+    flow_metrics.record_frame()
+    delay = bucket.take()
+    if delay > 0:
+        flow_metrics.record_throttle(delay)
+        await asyncio.sleep(delay)
+
+
+class Slot:
+    """A turn taken from a FairScheduler; released at most once."""
+
+    def __init__(self, scheduler: "FairScheduler"):
+        self._scheduler = scheduler
+        self.held = True
+
+    def release(self):
+        """Give the slot back early, e.g. before waiting on other sockets."""
+        if self.held:
+            self.held = False
+            self._scheduler._release()
+
+
+class FairScheduler:
+    """At most `slots` frames handled at once; waiters served in arrival order."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_flight = 0
+        self._waiters = deque()
+
+    @asynccontextmanager
+    async def turn(self):
+        queued = self.in_flight >= self.slots or bool(self._waiters)
+        if not queued:
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            start = time.monotonic()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.cancelled():
+                    # The slot was handed to us just as we were cancelled
+                    self._release()
+                raise
+            flow_metrics.record_queue_wait(time.monotonic() - start)
+        slot = Slot(self)
+        try:
+            if not queued:
+                # Let other sockets' ready frames go first
+                await asyncio.sleep(0)
+            yield slot
+        finally:
+            slot.release()
+
+    def _release(self):
+        # Hand the slot straight to the oldest waiter, so the connection
+        # releasing it can't take it back ahead of them
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": sum(1 for w in self._waiters if not w.done()),
+            "slots": self.slots,
+        }
+
+
+frame_scheduler = FairScheduler(WS_MAX_CONCURRENT_FRAMES)
@@ -0,0 +1,148 @@
+# groups.py
+"""
+Group conversations: membership queries, delivery cursors and fan-out.
+
+A group message is stored once (GroupMessage) with the body encrypted a
+single time and the message key wrapped per member. Each member receives
+the body plus only their own wrapped key. Instead of a delivered flag per
+recipient, every membership keeps last_delivered_id, so delivering to N
+members is one UPDATE, not N rows.
+
+Attachments are FileMessage rows with group_id set: uploaded once, readable
+by every member. Their file key travels inside a group message.
+"""
+import asyncio
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import ciphertext as ct
+import models
+
+MAX_GROUP_MEMBERS = int(os.getenv("MAX_GROUP_MEMBERS", "256"))
+
+
+def members(db: Session, group_id: int) -> Dict[int, str]:
+    """user_id -> username for everyone in the group."""
+    rows = (
+        db.query(models.GroupMember.user_id, models.User.username)
+        .join(models.User, models.User.id == models.GroupMember.user_id)
+        .filter(models.GroupMember.group_id == group_id)
+    )
+    return {user_id: username for user_id, username in rows}
+
+
+def membership(db: Session, group_id: int, user_id: int) -> Optional[models.GroupMember]:
+    return db.get(models.GroupMember, (group_id, user_id))
+
+
+def add_members(db: Session, group_id: int, user_ids: Iterable[int]):
+    """Join users to a group; they only see messages sent from now on."""
+    latest = db.query(func.max(models.GroupMessage.id)).filter(
+        models.GroupMessage.group_id == group_id
+    ).scalar() or 0
+    for user_id in user_ids:
+        db.add(models.GroupMember(
+            group_id=group_id,
+            user_id=user_id,
+            joined_after_id=latest,
+            last_delivered_id=latest,
+        ))
+
+
+def message_body(msg: models.GroupMessage, from_username: str) -> dict:
+    """The part of a /ws group_message frame that is the same for every member."""
+    return {
+        "type": "group_message",
+        "id": msg.id,
+        "group_id": msg.group_id,
+        "from": from_username,
+        "ciphertext": msg.ciphertext,
+        "created_at": msg.created_at.isoformat() if msg.created_at else None,
+    }
+
+
+def message_frame(msg: models.GroupMessage, from_username: str, keys: dict, user_id: int) -> dict:
+    """The /ws frame for one member: shared body, their own wrapped key."""
+    return {**message_body(msg, from_username), "key": keys.get(str(user_id))}
+
+
+def history_entry(row, user_id: int) -> dict:
+    """
+    REST form of a group message (ciphertext unpacked for JSON) from a
+    (id, group_id, from_username, ciphertext, keys, created_at) row.
+    """
+    msg_id, group_id, from_username, ciphertext, keys, created_at = row
+    return {
+        "id": msg_id,
+        "group_id": group_id,
+        "from": from_username,
+        "ciphertext": ct.unpack(ciphertext),
+        "key": json.loads(keys).get(str(user_id)),
+        "created_at": created_at,
+    }
+
+
+def pending_for_user(db: Session, user_id: int) -> List[dict]:
+    """Frames for every group message past the user's cursors, oldest first."""
+    rows = (
+        db.query(models.GroupMessage, models.User.username)
+        .join(
+            models.GroupMember,
+            (models.GroupMember.group_id == models.GroupMessage.group_id)
+            & (models.GroupMember.user_id == user_id),
+        )
+        .outerjoin(models.User, models.User.id == models.GroupMessage.from_user_id)
+        .filter(models.GroupMessage.id > models.GroupMember.last_delivered_id)
+        .order_by(models.GroupMessage.id)
+        .all()
+    )
+    return [message_frame(msg, from_username, json.loads(msg.keys), user_id) for msg, from_username in rows]
+
+
+def advance_cursors(
+    db: Session,
+    group_id: int,
+    user_ids: Iterable[int],
+    message_id: int,
+    first_id: Optional[int] = None,
+):
+    """
+    Mark messages first_id..message_id (default: just message_id) delivered
+    to user_ids. A cursor only moves if it already covers everything before
+    first_id; a member who missed an earlier message keeps their cursor and
+    gets it (and the ones after it) again on reconnect.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    before = db.query(func.max(models.GroupMessage.id)).filter(
+        models.GroupMessage.group_id == group_id,
+        models.GroupMessage.id < (message_id if first_id is None else first_id),
+    ).scalar() or 0
+    db.query(models.GroupMember).filter(
+        models.GroupMember.group_id == group_id,
+        models.GroupMember.user_id.in_(user_ids),
+        models.GroupMember.last_delivered_id >= before,
+        models.GroupMember.last_delivered_id < message_id,
+    ).update({models.GroupMember.last_delivered_id: message_id}, synchronize_session=False)
+
+
+async def fan_out(connections: dict, frames: Dict[int, Any]) -> Set[int]:
+    """
+    Send each user their frame concurrently, to whoever is online. Returns
+    the user ids it reached; a slow or broken socket doesn't hold up the rest.
+    Frames may be dicts or pre-encoded wire.Frame objects shared between users.
+    """
+    targets = [(user_id, connections[user_id]) for user_id in frames if user_id in connections]
+    if not targets:
+        return set()
+
+    results = await asyncio.gather(
+        *(conn.send(frames[user_id]) for user_id, conn in targets),
+        return_exceptions=True,
+    )
+    return {user_id for (user_id, _), result in zip(targets, results) if not isinstance(result, Exception)}
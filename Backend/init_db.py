@@ -0,0 +1,62 @@
+# init_db.py
+"""
+Create database tables that don't exist yet.
+
+The API does this on startup unless AUTO_CREATE_TABLES=false; in that case
+run it once per deploy instead:
+    python init_db.py
+
+At startup every worker would run it at once, racing on CREATE TABLE, so
+there init_db_serialized() takes the "create_tables" lease first: the
+first worker creates the tables, the others wait their turn and find them
+already there.
+"""
+import time
+from datetime import timedelta
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import DatabaseError
+
+from database import Base, engine
+import leader
+import models
+
+CREATE_TABLES_LEASE = "create_tables"
+CREATE_TABLES_LEASE_TTL = timedelta(minutes=5)  # frees it if the holder dies mid-way
+CREATE_TABLES_TIMEOUT = 120  # seconds a worker waits for its turn
+
+
+def init_db():
+    Base.metadata.create_all(bind=engine)
+
+
+def _create_lease_table():
+    # The lease itself needs its table; two workers may create it together
+    try:
+        models.JobLease.__table__.create(bind=engine, checkfirst=True)
+    except DatabaseError:
+        if not inspect(engine).has_table(models.JobLease.__tablename__):
+            raise
+
+
+def init_db_serialized():
+    """init_db(), one worker at a time."""
+    _create_lease_table()
+    deadline = time.monotonic() + CREATE_TABLES_TIMEOUT
+    while not leader.try_acquire(CREATE_TABLES_LEASE, CREATE_TABLES_LEASE_TTL):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out waiting for another worker to create tables")
+        time.sleep(0.2)
+    try:
+        init_db()
+    finally:
+        leader.release(CREATE_TABLES_LEASE)
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    init_db()
+    print(f"✅ Tables ready ({(time.perf_counter() - start) * 1000:.0f} ms)")
@@ -0,0 +1,191 @@
+# jobs.py
+"""
+Lightweight in-process job queue for side effects that shouldn't hold up a
+request: WebSocket notifications, file deletions, scheduled cleanup.
+
+    @job_queue.task("delete_upload")
+    def delete_upload(stored_filename): ...
+
+    job_queue.enqueue("delete_upload", "20260115_123021_066c5aee03ca92a8.png")
+
+Async handlers run on the event loop; plain functions run in a thread so DB
+and disk work never blocks it. `concurrency` bounds how many jobs run at
+once, failed jobs are retried with exponential backoff, and `stats()`
+reports queue depth and counters.
+"""
+import asyncio
+import inspect
+import os
+import threading
+from typing import Any, Callable, Dict
+
+
+class Job:
+    def __init__(self, name: str, args: tuple, kwargs: dict):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.attempt = 0
+
+
+class JobQueue:
+    def __init__(
+        self,
+        concurrency: int = 4,
+        maxsize: int = 10000,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+    ):
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.handlers: Dict[str, Callable] = {}
+
+        self._queue: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._workers: list[asyncio.Task] = []
+        self._lock = threading.Lock()
+        self.counters = {
+            "enqueued": 0,
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+        }
+        self.running = 0
+
+    def task(self, name: str):
+        """Register a handler under `name`."""
+        def decorator(fn: Callable) -> Callable:
+            self.handlers[name] = fn
+            return fn
+        return decorator
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    # ----- producer side ----- #
+
+    def enqueue(self, name: str, *args: Any, **kwargs: Any) -> bool:
+        """
+        Queue a job without waiting for it. Safe to call from the event loop
+        or from any thread.
+
+        Returns False only when the job is dropped on the spot: the queue
+        isn't started, or it is full and this was called on the event loop.
+        From another thread the put is handed to the loop and True means
+        "handed over"; if the queue turns out to be full then, the drop
+        only shows in stats()["dropped"].
+        """
+        if name not in self.handlers:
+            raise KeyError(f"Unknown job: {name}")
+
+        if self._queue is None:
+            print(f"⚠️  [JOBS] Queue not started, dropping {name}")
+            self._count("dropped")
+            return False
+
+        job = Job(name, args, kwargs)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self._loop:
+            return self._put(job)
+
+        # Outcome unknown here (see docstring); don't block the caller on the loop
+        self._loop.call_soon_threadsafe(self._put, job)
+        return True
+
+    def _put(self, job: Job) -> bool:
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            print(f"⚠️  [JOBS] Queue full, dropping {job.name}")
+            self._count("dropped")
+            return False
+        self._count("enqueued")
+        return True
+
+    # ----- consumer side ----- #
+
+    async def start(self):
+        """Start worker tasks on the current event loop."""
+        if self._queue is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        """Give queued jobs a moment to finish, then cancel the workers."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️  [JOBS] {self._queue.qsize()} jobs left unfinished at shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            self.running += 1
+            try:
+                await self._run(job)
+            finally:
+                self.running -= 1
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        handler = self.handlers[job.name]
+        job.attempt += 1
+        try:
+            if inspect.iscoroutinefunction(handler):
+                await handler(*job.args, **job.kwargs)
+            else:
+                await asyncio.to_thread(handler, *job.args, **job.kwargs)
+            self._count("completed")
+        except Exception as e:
+            if job.attempt > self.max_retries:
+                print(f"❌ [JOBS] {job.name} failed after {job.attempt} attempts: {e}")
+                self._count("failed")
+                return
+            delay = self.retry_delay * 2 ** (job.attempt - 1)
+            print(f"⚠️  [JOBS] {job.name} failed ({e}), retrying in {delay:.1f}s")
+            self._count("retried")
+            self._loop.call_later(delay, self._put_retry, job)
+
+    def _put_retry(self, job: Job):
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._count("dropped")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(
+            depth=self._queue.qsize() if self._queue is not None else 0,
+            running=self.running,
+            concurrency=self.concurrency,
+        )
+        return stats
+
+
+job_queue = JobQueue(
+    concurrency=int(os.getenv("JOB_CONCURRENCY", "4")),
+    maxsize=int(os.getenv("JOB_QUEUE_SIZE", "10000")),
+    max_retries=int(os.getenv("JOB_MAX_RETRIES", "3")),
+)
@@ -0,0 +1,68 @@
+# leader.py
+"""
+Single-leader coordination for scheduled jobs across uvicorn workers.
+
+Every worker fires the same cron triggers; each run first tries to take a
+row-level lease in the job_leases table and only the winner does the work.
+The lease is left to expire instead of being released, so workers whose
+trigger fires a little later skip that slot too.
+"""
+import functools
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+import models
+from database import SessionLocal
+
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def try_acquire(name: str, ttl: timedelta) -> bool:
+    """Take (or renew) the lease `name` for `ttl`. Returns True if we hold it."""
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        taken = db.query(models.JobLease).filter(
+            models.JobLease.name == name,
+            (models.JobLease.expires_at < now) | (models.JobLease.holder == HOLDER_ID),
+        ).update(
+            {models.JobLease.holder: HOLDER_ID, models.JobLease.expires_at: now + ttl},
+            synchronize_session=False,
+        )
+        if taken:
+            db.commit()
+            return True
+
+        # No row yet (first run ever) - whoever inserts it first wins
+        db.add(models.JobLease(name=name, holder=HOLDER_ID, expires_at=now + ttl))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return False
+        return True
+
+
+def run_as_leader(name: str, ttl: timedelta):
+    """Decorator: run the job only in the worker that wins the lease."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not try_acquire(name, ttl):
+                print(f"ℹ️  [LEADER] {name} is running in another worker, skipping")
+                return None
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def release(name: str):
+    """Give up the lease `name` early, if we hold it."""
+    with SessionLocal() as db:
+        db.query(models.JobLease).filter(
+            models.JobLease.name == name,
+            models.JobLease.holder == HOLDER_ID,
+        ).update({models.JobLease.expires_at: datetime.utcnow()}, synchronize_session=False)
+        db.commit()
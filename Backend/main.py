@@ -1,39 +1,61 @@
 # main.py
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, File, UploadFile, Form
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, File, UploadFile, Form, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware 
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
-import atexit 
 from jose import JWTError, jwt
-from typing import Dict , List
+from typing import Dict , List, Optional
 import os
 import shutil
+import hashlib
+import json
+import threading
 import mimetypes
 from pathlib import Path
-import magic
+import asyncio
 from dotenv import load_dotenv
 load_dotenv()
 from sqlalchemy import or_, and_
 
-from database import Base, engine, SessionLocal
+from database import Base, engine, replica_engines, SessionLocal, read_session, pool_metrics, recent_writers
 import models
 import auth
+import wire
+import ciphertext as ct
+import tasks
+from init_db import init_db_serialized
+import sync
+import tombstones
+import usage
+import offline_log
+import groups
+import export
+import flowcontrol
+from flowcontrol import flow_metrics, frame_scheduler
+from fastjson import FastJSONResponse
+from cache import LRUCache
+from jobs import job_queue
+import storage
+from storage import UPLOAD_DIR
+from sniffing import SNIFF_BYTES, sniff_content, sniff_executor
 from schemas import (
     RegisterRequest,
     LoginRequest,
     TokenResponse,
     PublicKeysResponse,
+    BulkKeysRequest,
+    BulkKeysResponse,
     UserInfoResponse,
     UpdatePublicKeyRequest,
+    CreateGroupRequest,
+    GroupMembersRequest,
+    GroupResponse,
 )
 
-# Create tables if they don't exist
-Base.metadata.create_all(bind=engine)
+app = FastAPI(title="Sandeshaa Backend (Prototype)", default_response_class=FastJSONResponse)
 
-app = FastAPI(title="Sandeshaa Backend (Prototype)")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:5174", "http://127.0.0.1:5173", "http://127.0.0.1:5174", "http://192.168.1.65:5173", "http://192.168.1.65:5174"],
@@ -44,9 +66,18 @@ app.add_middleware(
 
 # HTTP Bearer auth for JWT tokens (Authorization: Bearer <token>)
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
-# In-memory mapping of user_id -> WebSocket connection
-active_connections: Dict[int, WebSocket] = {}
+# In-memory mapping of user_id -> negotiated WebSocket connection
+active_connections: Dict[int, wire.Connection] = {}
+
+
+# Public key lookups: username -> (PublicKeysResponse dict, ETag)
+KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", "10000"))
+KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", "30"))  # bounds staleness across workers
+KEYS_MAX_AGE = int(os.getenv("KEYS_MAX_AGE", "0"))  # 0 = clients always revalidate
+MAX_BULK_KEYS = 100
+public_key_cache = LRUCache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL)
 
 
 # DB session dependency
@@ -58,11 +89,25 @@ def get_db():
         db.close()
 
 
-# Get current user from JWT token
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db),
-) -> models.User:
+# Read-only endpoints: a replica when configured, the primary for users
+# who wrote within READ_YOUR_WRITES_SECONDS (see database.read_session)
+def get_read_db(
+    credentials: HTTPAuthorizationCredentials | None = Depends(optional_security),
+):
+    user_id = None
+    if credentials is not None:
+        try:
+            user_id = int(jwt.decode(credentials.credentials, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])["sub"])
+        except (JWTError, KeyError, ValueError):
+            pass  # get_current_user_read rejects it
+    db = read_session(user_id)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _authenticate(credentials: HTTPAuthorizationCredentials, db: Session) -> models.User:
     token = credentials.credentials
     print(f"🔍 Token received: {token[:30]}...")
 
@@ -91,9 +136,23 @@ def get_current_user(
 
     return user
 
-# Create uploads directory
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+
+# Get current user from JWT token
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db),
+) -> models.User:
+    user = _authenticate(credentials, db)
+    db.info["user_id"] = user.id  # writes in this session count for read-your-writes
+    return user
+
+
+# Same, loading the user through the request's read session
+def get_current_user_read(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_read_db),
+) -> models.User:
+    return _authenticate(credentials, db)
 
 # Allowed file types (whitelist approach - SAFER!)
 ALLOWED_EXTENSIONS = {
@@ -122,6 +181,8 @@ BLOCKED_EXTENSIONS = {
 # Maximum file size (10MB)
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 
+COPY_CHUNK_SIZE = 1024 * 1024
+
 def validate_file(file: UploadFile) -> tuple[bool, str]:
     """Validate uploaded file for security"""
     filename_lower = file.filename.lower()
@@ -152,96 +213,8 @@ def validate_file(file: UploadFile) -> tuple[bool, str]:
     if any(pattern in file.filename for pattern in suspicious_patterns):
         return False, "Invalid characters in filename"
     
-    # # ✅ NEW: Check 5: Validate file content using magic bytes
-    # try:
-    #     # Read first 2048 bytes for magic byte detection
-    #     file.file.seek(0)
-    #     file_header = file.file.read(2048)
-    #     file.file.seek(0)  # Reset for later use
-        
-    #     # Detect actual file type using magic bytes
-    #     mime = magic.Magic(mime=True)
-    #     detected_mime = mime.from_buffer(file_header)
-        
-    #     print(f"🔍 File: {file.filename}")
-    #     print(f"📄 Extension: {file_ext}")
-    #     print(f"🎯 Declared MIME: {file.content_type}")
-    #     print(f"🔬 Detected MIME (magic bytes): {detected_mime}")
-        
-    #     # Map extensions to expected MIME types
-    #     allowed_mime_types = {
-    #         # Images
-    #         '.jpg': ['image/jpeg'],
-    #         '.jpeg': ['image/jpeg'],
-    #         '.png': ['image/png'],
-    #         '.gif': ['image/gif'],
-    #         '.webp': ['image/webp'],
-    #         '.bmp': ['image/bmp', 'image/x-ms-bmp'],
-    #         '.svg': ['image/svg+xml', 'text/xml', 'text/plain'],
-            
-    #         # Documents
-    #         '.pdf': ['application/pdf'],
-    #         '.doc': ['application/msword', 'application/x-ole-storage'],
-    #         '.docx': ['application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/zip'],
-    #         '.txt': ['text/plain'],
-    #         '.rtf': ['application/rtf', 'text/rtf'],
-    #         '.odt': ['application/vnd.oasis.opendocument.text', 'application/zip'],
-            
-    #         # Spreadsheets
-    #         '.xls': ['application/vnd.ms-excel', 'application/x-ole-storage'],
-    #         '.xlsx': ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/zip'],
-    #         '.csv': ['text/csv', 'text/plain'],
-    #         '.ods': ['application/vnd.oasis.opendocument.spreadsheet', 'application/zip'],
-            
-    #         # Presentations
-    #         '.ppt': ['application/vnd.ms-powerpoint', 'application/x-ole-storage'],
-    #         '.pptx': ['application/vnd.openxmlformats-officedocument.presentationml.presentation', 'application/zip'],
-    #         '.odp': ['application/vnd.oasis.opendocument.presentation', 'application/zip'],
-            
-    #         # Archives
-    #         '.zip': ['application/zip'],
-    #         '.rar': ['application/x-rar', 'application/x-rar-compressed'],
-    #         '.7z': ['application/x-7z-compressed'],
-            
-    #         # Media
-    #         '.mp3': ['audio/mpeg'],
-    #         '.mp4': ['video/mp4'],
-    #         '.wav': ['audio/wav', 'audio/x-wav'],
-    #         '.avi': ['video/x-msvideo'],
-    #         '.mov': ['video/quicktime'],
-    #     }
-        
-    #     expected_mimes = allowed_mime_types.get(file_ext, [])
-        
-    #     # Check if detected MIME matches expected types for this extension
-    #     if expected_mimes and detected_mime not in expected_mimes:
-    #         # Special case: Microsoft Office files (docx, xlsx, pptx) are actually ZIP files
-    #         if file_ext in ['.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp'] and detected_mime == 'application/zip':
-    #             print("✅ Office document validated (ZIP container)")
-    #             pass  # This is okay
-    #         else:
-    #             print(f"❌ MIME mismatch! Extension says {file_ext}, but content is {detected_mime}")
-    #             return False, f"File type mismatch! File extension is {file_ext} but content appears to be {detected_mime}. Possible spoofing attempt."
-    #     else:
-    #         print("✅ File type validated via magic bytes")
-        
-    #     # Extra check: Block executable files by magic bytes
-    #     dangerous_mime_patterns = [
-    #         'application/x-executable',
-    #         'application/x-dosexec',
-    #         'application/x-msdownload',
-    #         'application/x-msdos-program',
-    #         'application/x-sh',
-    #         'application/x-shellscript',
-    #     ]
-        
-    #     if any(pattern in detected_mime for pattern in dangerous_mime_patterns):
-    #         return False, "Executable files are not allowed"
-        
-    # except Exception as e:
-    #     print(f"⚠️ Magic byte validation warning: {e}")
-    #     # Don't fail if magic library has issues, just log warning
-    #     print("⚠️ Continuing without magic byte validation")
+    # Check 5 (content / magic bytes) runs in upload_file while the file is
+    # being written, see sniffing.py
     
     return True, "OK"
 
@@ -254,8 +227,16 @@ def read_root():
 
 @app.get("/debug/users-count")
 def get_users_count(db: Session = Depends(get_db)):
-    count = db.query(models.User).count()
-    return {"users_count": count}
+    return {"users_count": usage.users_count(db)}
+
+
+@app.get("/debug/db-pool")
+def get_db_pool_stats():
+    """Connection pool checkout wait/hold times, for sizing DB_POOL_SIZE."""
+    stats = pool_metrics.snapshot(engine.pool)
+    if replica_engines:
+        stats["replicas"] = [pool_metrics.occupancy(e.pool) for e in replica_engines]
+    return stats
 
 
 # ----------------- AUTH & USER ENDPOINTS ----------------- #
@@ -287,6 +268,10 @@ def register_user(req: RegisterRequest, db: Session = Depends(get_db)):
     )
 
     db.add(user)
+    db.flush()
+    usage.create(db, user.id)
+    # Counts as their write: replicas may not have the account yet
+    db.info["user_id"] = user.id
     db.commit()
     db.refresh(user)
 
@@ -309,11 +294,15 @@ def login(req: LoginRequest, db: Session = Depends(get_db)):
     # Store user.id as "sub" in token
     token = auth.create_access_token({"sub": str(user.id)})#This line is changed to string 
 
+    # Keep their first reads on the primary: a just-registered account (on
+    # another worker) may not have reached the replicas yet
+    recent_writers.note(user.id)
+
     return TokenResponse(access_token=token)
 
 
 @app.get("/me", response_model=UserInfoResponse)
-def read_me(current_user: models.User = Depends(get_current_user)):
+def read_me(current_user: models.User = Depends(get_current_user_read)):
     """
     Return the current logged-in user's basic info.
     Protected by JWT.
@@ -321,6 +310,15 @@ def read_me(current_user: models.User = Depends(get_current_user)):
     return UserInfoResponse(id=current_user.id, username=current_user.username)
 
 
+@app.get("/me/usage")
+def get_my_usage(
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """What the current user has stored on the server, and their quotas."""
+    return usage.snapshot(usage.get(db, current_user.id))
+
+
 @app.put("/me/public-key")
 def update_public_key(
     req: UpdatePublicKeyRequest,
@@ -334,12 +332,13 @@ def update_public_key(
     current_user.identity_public_key = req.identity_public_key
     current_user.prekey_public = req.identity_public_key  # Keep in sync
     db.commit()
+    public_key_cache.pop(current_user.username)
     return {"status": "ok", "message": "Public key updated"}
 
 @app.get("/conversations")
 def get_conversations(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db),
 ):
     """
     Return list of all users the current user has exchanged messages with,
@@ -365,6 +364,9 @@ def get_conversations(
     for row in received_from:
         all_user_ids.add(row[0])
     
+    # Deleted conversations stay hidden until they are purged
+    deleted_upto = tombstones.watermarks_for_user(db, current_user.id)
+
     # Get user details and last message for each conversation
     conversations = []
     for user_id in all_user_ids:
@@ -385,7 +387,8 @@ def get_conversations(
                         models.Message.from_user_id == user_id,
                         models.Message.to_user_id == current_user.id,
                     ),
-                )
+                ),
+                models.Message.id > deleted_upto.get(user_id, (0, 0))[0],
             )
             .order_by(models.Message.created_at.desc())
             .first()
@@ -405,19 +408,31 @@ def get_conversations(
 @app.get("/messages/{other_username}")
 def get_messages_with_user(
     other_username: str,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db),
 ):
     """
     Return the last 100 messages between current_user and other_username.
     Only ciphertext is returned (still end-to-end encrypted).
+
+    Selects plain columns rather than ORM objects and returns the rows
+    already shaped for the response, so there is no model instantiation
+    or jsonable_encoder pass per message (history pages are hot).
     """
     other = db.query(models.User).filter(models.User.username == other_username).first()
     if not other:
         raise HTTPException(status_code=404, detail="User not found")
 
-    msgs = (
-        db.query(models.Message)
+    message_watermark, _ = tombstones.watermarks(db, current_user.id, other.id)
+
+    rows = (
+        db.query(
+            models.Message.id,
+            models.Message.from_user_id,
+            models.Message.to_user_id,
+            models.Message.ciphertext,
+            models.Message.created_at,
+        )
         .filter(
             or_(
                 and_(
@@ -428,40 +443,52 @@ def get_messages_with_user(
                     models.Message.from_user_id == other.id,
                     models.Message.to_user_id == current_user.id,
                 ),
-            )
+            ),
+            models.Message.id > message_watermark,
         )
         .order_by(models.Message.created_at.desc())
         .limit(100)
         .all()
     )
 
-    return [
+    return FastJSONResponse([
         {
-            "id": m.id,
-            "from_user_id": m.from_user_id,
-            "to_user_id": m.to_user_id,
-            "ciphertext": m.ciphertext,
-            "created_at": m.created_at.isoformat() if m.created_at else None,
+            "id": msg_id,
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "ciphertext": ct.unpack(ciphertext),
+            "created_at": created_at,
         }
-        for m in msgs
-    ]
+        for msg_id, from_user_id, to_user_id, ciphertext, created_at in rows
+    ])
 
 
 @app.get("/file-messages/{other_username}")
 def get_file_messages_with_user(
     other_username: str,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db),
 ):
     """
     Return the last 100 file messages between current_user and other_username.
+    Column rows, returned directly (see get_messages_with_user).
     """
     other = db.query(models.User).filter(models.User.username == other_username).first()
     if not other:
         raise HTTPException(status_code=404, detail="User not found")
 
-    file_msgs = (
-        db.query(models.FileMessage)
+    _, file_watermark = tombstones.watermarks(db, current_user.id, other.id)
+
+    rows = (
+        db.query(
+            models.FileMessage.id,
+            models.FileMessage.from_user_id,
+            models.FileMessage.to_user_id,
+            models.FileMessage.filename,
+            models.FileMessage.file_size,
+            models.FileMessage.file_type,
+            models.FileMessage.created_at,
+        )
         .filter(
             or_(
                 and_(
@@ -472,25 +499,79 @@ def get_file_messages_with_user(
                     models.FileMessage.from_user_id == other.id,
                     models.FileMessage.to_user_id == current_user.id,
                 ),
-            )
+            ),
+            models.FileMessage.id > file_watermark,
         )
         .order_by(models.FileMessage.created_at.desc())
         .limit(100)
         .all()
     )
 
-    return [
+    return FastJSONResponse([
         {
-            "id": m.id,
-            "from_user_id": m.from_user_id,
-            "to_user_id": m.to_user_id,
-            "filename": m.filename,
-            "file_size": m.file_size,
-            "file_type": m.file_type,
-            "created_at": m.created_at.isoformat() if m.created_at else None,
+            "id": file_id,
+            "from_user_id": from_user_id,
+            "to_user_id": to_user_id,
+            "filename": filename,
+            "file_size": file_size,
+            "file_type": file_type,
+            "created_at": created_at,
         }
-        for m in file_msgs
-    ]
+        for file_id, from_user_id, to_user_id, filename, file_size, file_type, created_at in rows
+    ])
+
+
+@app.get("/sync")
+def sync_changes(
+    since: int = 0,
+    limit: int = 1000,
+    current_user: models.User = Depends(get_current_user),
+):
+    """
+    Everything that changed for the current user since `since` (a cursor
+    from a previous sync): new messages and files in every conversation,
+    delivery receipts and deleted conversations, streamed as NDJSON.
+    The last line carries the next cursor.
+    """
+    if since < 0 or not 1 <= limit <= 5000:
+        raise HTTPException(status_code=400, detail="Invalid since/limit")
+
+    return StreamingResponse(
+        sync.stream_changes(current_user.id, since, limit),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.get("/export/{username}")
+def export_conversation(
+    username: str,
+    cursor: Optional[str] = None,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    The entire conversation with `username` (messages, then file messages)
+    as NDJSON, streamed with constant memory. Pass the cursor of the last
+    line received to resume an interrupted export.
+    """
+    other = db.query(models.User).filter(models.User.username == username).first()
+    if not other:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    try:
+        position = export.parse_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    return StreamingResponse(
+        export.stream_conversation(
+            current_user.id,
+            other.id,
+            {current_user.id: current_user.username, other.id: other.username},
+            position,
+        ),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.delete("/messages/{username}")
@@ -500,8 +581,12 @@ def delete_messages_with_user(
     db: Session = Depends(get_db),
 ):
     """
-    Delete all messages between the current user and the specified user.
-    This deletes messages in both directions (sent and received).
+    Delete the whole conversation (messages and files, both directions)
+    between the current user and the specified user.
+
+    This only records a tombstone: the conversation disappears from every
+    read immediately, and the rows and stored files are purged in batches
+    by a background job.
     """
     # Find the other user
     other_user = db.query(models.User).filter(models.User.username == username).first()
@@ -511,22 +596,16 @@ def delete_messages_with_user(
             detail="User not found",
         )
     
-    # Delete all messages between these two users
-    deleted_count = db.query(models.Message).filter(
-        or_(
-            and_(
-                models.Message.from_user_id == current_user.id,
-                models.Message.to_user_id == other_user.id,
-            ),
-            and_(
-                models.Message.from_user_id == other_user.id,
-                models.Message.to_user_id == current_user.id,
-            ),
-        )
-    ).delete(synchronize_session=False)
-    
+    tombstone, deleted_count = tombstones.create(db, current_user.id, other_user.id)
+    sync.record(db, sync.CONVERSATION_DELETED, [current_user.id], peer_id=other_user.id)
+    sync.record(db, sync.CONVERSATION_DELETED, [other_user.id], peer_id=current_user.id)
     db.commit()
+
+    job_queue.enqueue("purge_conversation", tombstone.id)
+    queue_deletion_event(current_user.id, other_user.username)
+    queue_deletion_event(other_user.id, current_user.username)
     
+    # Rows are purged asynchronously; the count is what the tombstone hides
     return {
         "status": "ok",
         "message": f"Deleted {deleted_count} messages",
@@ -534,38 +613,120 @@ def delete_messages_with_user(
     }
 
 
+def _public_keys_entry(user: models.User) -> tuple[dict, str]:
+    keys = {
+        "username": user.username,
+        "identity_public_key": user.identity_public_key,
+        "prekey_public": user.prekey_public,
+    }
+    digest = hashlib.sha256(
+        f"{user.identity_public_key}:{user.prekey_public}".encode("utf-8")
+    ).hexdigest()
+    return keys, f'"{digest[:32]}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def _keys_cache_control() -> str:
+    if KEYS_MAX_AGE > 0:
+        return f"public, max-age={KEYS_MAX_AGE}"
+    return "public, no-cache"
+
+
 @app.get("/users/{username}/keys", response_model=PublicKeysResponse)
-def get_user_keys(username: str, db: Session = Depends(get_db)):
+def get_user_keys(username: str, request: Request, db: Session = Depends(get_db)):
     """
     Return the identity_public_key and prekey_public for a given username.
     Anyone can call this (no auth required), since keys are public.
+
+    Served from an in-memory LRU when possible, with an ETag so clients and
+    proxies can revalidate and get a bodyless 304. Misses read the primary,
+    never a replica: a lagging replica could re-cache a key that
+    update_public_key just replaced.
     """
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user:
+    entry = public_key_cache.get(username)
+    if entry is None:
+        user = db.query(models.User).filter(models.User.username == username).first()
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found",
+            )
+        entry = _public_keys_entry(user)
+        public_key_cache.set(username, entry)
+
+    keys, etag = entry
+    headers = {"ETag": etag, "Cache-Control": _keys_cache_control()}
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return JSONResponse(content=keys, headers=headers)
+
+
+@app.post("/users/keys", response_model=BulkKeysResponse)
+def get_users_keys_bulk(req: BulkKeysRequest, db: Session = Depends(get_db)):
+    """
+    Return public keys for many users in one request (e.g. when a client
+    opens several chats at once). Unknown usernames are listed in "missing".
+    Cache misses read the primary, like get_user_keys.
+    """
+    usernames = list(dict.fromkeys(req.usernames))
+    if len(usernames) > MAX_BULK_KEYS:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BULK_KEYS} usernames per request",
         )
 
-    return PublicKeysResponse(
-        username=user.username,
-        identity_public_key=user.identity_public_key,
-        prekey_public=user.prekey_public,
+    found = {}
+    uncached = []
+    for username in usernames:
+        entry = public_key_cache.get(username)
+        if entry is None:
+            uncached.append(username)
+        else:
+            found[username] = entry[0]
+
+    if uncached:
+        users = db.query(models.User).filter(models.User.username.in_(uncached)).all()
+        for user in users:
+            entry = _public_keys_entry(user)
+            public_key_cache.set(user.username, entry)
+            found[user.username] = entry[0]
+
+    return BulkKeysResponse(
+        keys=[found[u] for u in usernames if u in found],
+        missing=[u for u in usernames if u not in found],
     )
 
 @app.post("/upload-file")
 async def upload_file(
     file: UploadFile = File(...),
-    to_username: str = Form(...),
+    to_username: Optional[str] = Form(None),
+    group_id: Optional[int] = Form(None),
     current_user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Upload encrypted file with security validation"""
+    """
+    Upload encrypted file with security validation, for one user
+    (to_username) or shared once with a whole group (group_id).
+    """
+    if (to_username is None) == (group_id is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of to_username or group_id")
     
     # Validate file
     is_valid, error_msg = validate_file(file)
     if not is_valid:
         raise HTTPException(status_code=400, detail=error_msg)
+
+    # Reject over-quota uploads before anything is written to UPLOAD_DIR
+    if not usage.has_room(usage.get(db, current_user.id), file_bytes=file.size):
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
     
     try:
         # Sanitize filename
@@ -579,50 +740,82 @@ async def upload_file(
         stored_filename = f"{timestamp}_{unique_id}{file_ext}"
         file_path = UPLOAD_DIR / stored_filename
         
-        # Save file
+        # Save file, sniffing the first chunk in the thread pool meanwhile
+        header = await file.read(SNIFF_BYTES)
+        sniff = asyncio.get_running_loop().run_in_executor(
+            sniff_executor, sniff_content, header, file_ext.lower()
+        )
         with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Get recipient
-        recipient = db.query(models.User).filter(
-            models.User.username == to_username
-        ).first()
-        
-        if not recipient:
+            buffer.write(header)
+            await asyncio.to_thread(shutil.copyfileobj, file.file, buffer, COPY_CHUNK_SIZE)
+
+        is_valid, error_msg = await sniff
+        if not is_valid:
             os.remove(file_path)
-            raise HTTPException(status_code=404, detail="Recipient not found")
+            raise HTTPException(status_code=400, detail=error_msg)
+        
+        # Get recipient(s)
+        if group_id is not None:
+            recipient = None
+            member_names = groups.members(db, group_id)
+            if current_user.id not in member_names:
+                os.remove(file_path)
+                raise HTTPException(status_code=404, detail="Group not found")
+        else:
+            recipient = db.query(models.User).filter(
+                models.User.username == to_username
+            ).first()
+            
+            if not recipient:
+                os.remove(file_path)
+                raise HTTPException(status_code=404, detail="Recipient not found")
         
         # Create database record
         file_message = models.FileMessage(
             from_user_id=current_user.id,
-            to_user_id=recipient.id,
+            to_user_id=recipient.id if recipient else None,
+            group_id=group_id,
             filename=safe_filename,
             stored_filename=stored_filename,
             file_size=os.path.getsize(file_path),
             file_type=file.content_type,
             created_at=datetime.now()
         )
+
+        # Charged in the same transaction as the row, so racing uploads
+        # can't both fit in the last bit of quota
+        if not usage.charge(db, current_user.id, files=1, file_bytes=file_message.file_size):
+            db.rollback()
+            os.remove(file_path)
+            raise HTTPException(status_code=413, detail="Storage quota exceeded")
         
         db.add(file_message)
+        db.flush()
+        if recipient:
+            sync.record(db, sync.FILE_MESSAGE, [current_user.id, recipient.id], ref_id=file_message.id)
         db.commit()
         db.refresh(file_message)
 
-         # ✅ ADD THIS: Notify recipient via WebSocket if they're online
-        recipient_ws = active_connections.get(recipient.id)
-        if recipient_ws:
-            try:
-                await recipient_ws.send_json({
-                    "type": "file_message",
-                    "id": file_message.id,
-                    "from": current_user.username,
-                    "file_id": file_message.id,
-                    "filename": safe_filename,
-                    "file_size": file_message.file_size,
-                    "file_type": file.content_type,
-                    "created_at": file_message.created_at.isoformat() if file_message.created_at else None,
-                })
-            except Exception as e:
-                print(f"Failed to notify recipient: {e}")
+        # Notify recipient(s) via WebSocket if they're online, after responding
+        notification = {
+            "type": "file_message",
+            "id": file_message.id,
+            "from": current_user.username,
+            "file_id": file_message.id,
+            "filename": safe_filename,
+            "file_size": file_message.file_size,
+            "file_type": file.content_type,
+            "created_at": file_message.created_at.isoformat() if file_message.created_at else None,
+        }
+        if recipient:
+            job_queue.enqueue("notify_user", recipient.id, notification)
+        else:
+            notification["group_id"] = group_id
+            job_queue.enqueue(
+                "notify_users",
+                [uid for uid in member_names if uid != current_user.id],
+                notification,
+            )
         
         return {
             "message": "File uploaded successfully",
@@ -647,7 +840,10 @@ async def download_file(
     current_user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Download encrypted file"""
+    """
+    Download encrypted file. Authorization is checked here; the bytes are
+    sent by the worker or, with DOWNLOAD_MODE set, by the front proxy.
+    """
     file_message = db.query(models.FileMessage).filter(
         models.FileMessage.id == file_id
     ).first()
@@ -656,22 +852,447 @@ async def download_file(
         raise HTTPException(status_code=404, detail="File not found")
     
     # Check authorization
-    if file_message.to_user_id != current_user.id and file_message.from_user_id != current_user.id:  # NEW
-        raise HTTPException(status_code=403, detail="Unauthorized")
+    if file_message.group_id is not None:
+        if groups.membership(db, file_message.group_id, current_user.id) is None:
+            raise HTTPException(status_code=403, detail="Unauthorized")
+    else:
+        if file_message.to_user_id != current_user.id and file_message.from_user_id != current_user.id:  # NEW
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        _, file_watermark = tombstones.watermarks(db, file_message.from_user_id, file_message.to_user_id)
+        if file_message.id <= file_watermark:
+            raise HTTPException(status_code=404, detail="File not found")
     
     file_path = UPLOAD_DIR / file_message.stored_filename
     
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File no longer available")
     
-    return FileResponse(
-        path=file_path,
-        filename=file_message.filename,
-        media_type="application/octet-stream"
+    # Sent by the worker or handed to the front proxy (DOWNLOAD_MODE)
+    return storage.download_response(file_message.stored_filename, file_message.filename)
+
+# ----------------- GROUP ENDPOINTS ----------------- #
+
+def _membership_or_404(db: Session, group_id: int, user_id: int) -> models.GroupMember:
+    """user_id's membership of the group (404 if the group is missing too, so ids don't leak)."""
+    member = groups.membership(db, group_id, user_id)
+    if member is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return member
+
+
+def _group_for_member(db: Session, group_id: int, user_id: int) -> models.Group:
+    """The group, if user_id belongs to it (404 either way, so ids don't leak)."""
+    _membership_or_404(db, group_id, user_id)
+    return db.get(models.Group, group_id)
+
+
+def _users_by_username(db: Session, usernames: List[str]) -> Dict[str, models.User]:
+    wanted = set(usernames)
+    users = {
+        u.username: u
+        for u in db.query(models.User).filter(models.User.username.in_(wanted))
+    }
+    missing = sorted(wanted - users.keys())
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Users not found: {', '.join(missing)}")
+    return users
+
+
+def _group_response(db: Session, group: models.Group) -> GroupResponse:
+    member_names = groups.members(db, group.id)
+    creator = db.get(models.User, group.created_by)
+    return GroupResponse(
+        id=group.id,
+        name=group.name,
+        created_by=creator.username if creator else "",
+        members=sorted(member_names.values()),
+    )
+
+
+@app.post("/groups", response_model=GroupResponse)
+def create_group(
+    req: CreateGroupRequest,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Create a group with the current user and the given members."""
+    users = _users_by_username(db, req.members)
+    member_ids = {u.id for u in users.values()} | {current_user.id}
+    if len(member_ids) > groups.MAX_GROUP_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"Groups are limited to {groups.MAX_GROUP_MEMBERS} members")
+
+    group = models.Group(name=req.name, created_by=current_user.id)
+    db.add(group)
+    db.flush()
+    groups.add_members(db, group.id, member_ids)
+    db.commit()
+
+    return _group_response(db, group)
+
+
+@app.get("/groups", response_model=List[GroupResponse])
+def list_groups(
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Groups the current user belongs to."""
+    my_groups = (
+        db.query(models.Group)
+        .join(models.GroupMember, models.GroupMember.group_id == models.Group.id)
+        .filter(models.GroupMember.user_id == current_user.id)
+        .order_by(models.Group.id)
+        .all()
     )
+    return [_group_response(db, group) for group in my_groups]
+
+
+@app.get("/groups/{group_id}", response_model=GroupResponse)
+def get_group(
+    group_id: int,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    return _group_response(db, _group_for_member(db, group_id, current_user.id))
+
+
+@app.post("/groups/{group_id}/members", response_model=GroupResponse)
+def add_group_members(
+    group_id: int,
+    req: GroupMembersRequest,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Add users to a group. Any member can add; new members don't see earlier messages."""
+    group = _group_for_member(db, group_id, current_user.id)
+    users = _users_by_username(db, req.usernames)
+    current = groups.members(db, group_id)
+    new_ids = {u.id for u in users.values()} - current.keys()
+    if len(current) + len(new_ids) > groups.MAX_GROUP_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"Groups are limited to {groups.MAX_GROUP_MEMBERS} members")
+
+    groups.add_members(db, group_id, new_ids)
+    db.commit()
+
+    return _group_response(db, group)
+
+
+@app.delete("/groups/{group_id}/members/{username}")
+def remove_group_member(
+    group_id: int,
+    username: str,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Leave a group, or (creator only) remove someone from it."""
+    group = _group_for_member(db, group_id, current_user.id)
+    if username != current_user.username and group.created_by != current_user.id:
+        raise HTTPException(status_code=403, detail="Only the group creator can remove other members")
+
+    user = db.query(models.User).filter(models.User.username == username).first()
+    member = groups.membership(db, group_id, user.id) if user else None
+    if member is None:
+        raise HTTPException(status_code=404, detail="Member not found")
+
+    db.delete(member)
+    db.commit()
+
+    return {"status": "ok", "message": f"{username} removed from group"}
+
+
+@app.get("/groups/{group_id}/messages")
+def get_group_messages(
+    group_id: int,
+    after_id: int = 0,
+    limit: int = 100,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Group messages after `after_id`, oldest first (at most 500). Each entry
+    carries the shared ciphertext and only the current user's wrapped key.
+    """
+    member = _membership_or_404(db, group_id, current_user.id)
+
+    rows = (
+        db.query(
+            models.GroupMessage.id,
+            models.GroupMessage.group_id,
+            models.User.username,
+            models.GroupMessage.ciphertext,
+            models.GroupMessage.keys,
+            models.GroupMessage.created_at,
+        )
+        .outerjoin(models.User, models.User.id == models.GroupMessage.from_user_id)
+        .filter(
+            models.GroupMessage.group_id == group_id,
+            models.GroupMessage.id > max(after_id, member.joined_after_id),
+        )
+        .order_by(models.GroupMessage.id)
+        .limit(max(1, min(limit, 500)))
+        .all()
+    )
+    return FastJSONResponse([groups.history_entry(row, current_user.id) for row in rows])
+
+
+@app.get("/groups/{group_id}/file-messages")
+def get_group_file_messages(
+    group_id: int,
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Return the last 100 files shared in the group."""
+    _group_for_member(db, group_id, current_user.id)
+
+    rows = (
+        db.query(
+            models.FileMessage.id,
+            models.FileMessage.from_user_id,
+            models.FileMessage.filename,
+            models.FileMessage.file_size,
+            models.FileMessage.file_type,
+            models.FileMessage.created_at,
+        )
+        .filter(models.FileMessage.group_id == group_id)
+        .order_by(models.FileMessage.created_at.desc())
+        .limit(100)
+        .all()
+    )
+
+    return FastJSONResponse([
+        {
+            "id": file_id,
+            "from_user_id": from_user_id,
+            "group_id": group_id,
+            "filename": filename,
+            "file_size": file_size,
+            "file_type": file_type,
+            "created_at": created_at,
+        }
+        for file_id, from_user_id, filename, file_size, file_type, created_at in rows
+    ])
+
 
 # ----------------- WEBSOCKET CHAT ENDPOINT ----------------- #
 
+async def send_direct_message(
+    conn: wire.Connection, user_id: int, username: str, data: dict, slot: flowcontrol.Slot
+):
+    """
+    Store a one-to-one message, deliver it if the recipient is online and
+    acknowledge it to the sender. data: to, ciphertext, optional client_id.
+    The scheduler slot is released once the message is stored.
+    """
+    client_id = data.get("client_id")
+    to_username = data.get("to")
+    ciphertext = data.get("ciphertext")
+
+    # The codec has already packed ciphertext into bytes
+    if not to_username or not isinstance(ciphertext, bytes):
+        await conn.send(
+            {
+                "type": "error",
+                "message": "Missing 'to' or 'ciphertext' in send_message",
+            }
+        )
+        return
+
+    # user_id in info: the sender's next reads skip replicas
+    with SessionLocal(info={"user_id": user_id}) as db:
+        if not usage.has_room(usage.get(db, user_id), messages=1):
+            to_user = None
+            over_quota = True
+        else:
+            # Find recipient user
+            to_user = (
+                db.query(models.User)
+                .filter(models.User.username == to_username)
+                .first()
+            )
+            over_quota = to_user is not None and not usage.charge(db, user_id, messages=1)
+        if to_user and not over_quota:
+            # Save message in DB (encrypted ciphertext only)
+            new_msg = models.Message(
+                from_user_id=user_id,
+                to_user_id=to_user.id,
+                ciphertext=ciphertext,
+            )
+
+            db.add(new_msg)
+            db.flush()
+            sync.record(db, sync.MESSAGE, [user_id, to_user.id], ref_id=new_msg.id)
+            db.commit()
+            db.refresh(new_msg)
+            to_user_id = to_user.id
+            msg_id = new_msg.id
+            created_at = new_msg.created_at
+
+    if over_quota:
+        await conn.send(
+            {
+                "type": "error",
+                "message": "Message quota exceeded",
+                "client_id": client_id,
+            }
+        )
+        return
+
+    if not to_user:
+        await conn.send(
+            {
+                "type": "error",
+                "message": f"Recipient '{to_username}' not found",
+            }
+        )
+        return
+
+    # Stored: don't hold a slot while waiting on the recipient's socket
+    slot.release()
+
+    # Try to deliver in real-time if recipient is online
+    delivered = False
+    recipient_ws = active_connections.get(to_user_id)
+    if recipient_ws:
+        try:
+            await recipient_ws.send(
+                {
+                    "type": "message",
+                    "id": msg_id,
+                    "from": username,
+                    "ciphertext": ciphertext,
+                    "created_at": created_at.isoformat()
+                    if created_at
+                    else None,
+                }
+            )
+            delivered = True
+        except Exception:
+            # If sending to recipient fails, keep it undelivered;
+            # they'll fetch it next time they connect.
+            pass
+
+    if not delivered and offline_log.enabled:
+        try:
+            await asyncio.to_thread(
+                offline_log.append,
+                to_user_id,
+                offline_log.PendingMessage(
+                    msg_id,
+                    user_id,
+                    username,
+                    created_at.isoformat() if created_at else None,
+                    ciphertext,
+                ),
+            )
+        except OSError as e:
+            # Still undelivered in the DB; a backfill re-queues it
+            print(f"❌ [OFFLINE LOG] Append failed for user {to_user_id}: {e}")
+
+    if delivered:
+        with SessionLocal() as db:
+            db.query(models.Message).filter(
+                models.Message.id == msg_id
+            ).update({models.Message.delivered: True}, synchronize_session=False)
+            sync.record(db, sync.DELIVERED, [user_id], ref_id=msg_id)
+            db.commit()
+
+    # Acknowledge to sender
+    await conn.send(
+        {
+            "type": "sent",
+            "id": msg_id,
+            "to": to_username,
+            "delivered": delivered,
+            "client_id": client_id,
+        }
+    )
+
+
+async def send_group_message(
+    conn: wire.Connection, user_id: int, username: str, data: dict, slot: flowcontrol.Slot
+):
+    """
+    Store one envelope for the group and fan it out to every online member
+    at once. data: group_id, ciphertext (encrypted once for the group) and
+    keys (username -> message key wrapped for that member). The scheduler
+    slot is released before the fan-out.
+    """
+    client_id = data.get("client_id")
+    group_id = data.get("group_id")
+    ciphertext = data.get("ciphertext")
+    keys = data.get("keys")
+
+    if (
+        not isinstance(group_id, int)
+        or not isinstance(ciphertext, bytes)
+        or not isinstance(keys, dict)
+        or not all(isinstance(k, str) for k in keys.values())
+    ):
+        await conn.send(
+            {
+                "type": "error",
+                "message": "Missing 'group_id', 'ciphertext' or 'keys' in send_group_message",
+                "client_id": client_id,
+            }
+        )
+        return
+
+    error = None
+    with SessionLocal(info={"user_id": user_id}) as db:
+        member_names = groups.members(db, group_id)
+        missing = sorted(name for uid, name in member_names.items() if uid != user_id and name not in keys)
+        if user_id not in member_names:
+            error = "Group not found"
+        elif missing:
+            # Someone joined since the client built the envelope
+            error = f"Missing keys for: {', '.join(missing)}"
+        elif not usage.has_room(usage.get(db, user_id), messages=1) or not usage.charge(db, user_id, messages=1):
+            error = "Message quota exceeded"
+        else:
+            msg = models.GroupMessage(
+                group_id=group_id,
+                from_user_id=user_id,
+                ciphertext=ciphertext,
+                keys=json.dumps({str(uid): keys[name] for uid, name in member_names.items() if name in keys}),
+            )
+            db.add(msg)
+            db.commit()
+            db.refresh(msg)
+
+    if error:
+        await conn.send({"type": "error", "message": error, "client_id": client_id})
+        return
+
+    slot.release()
+
+    # Encode the shared body once per codec; each member's frame only
+    # appends their wrapped key to it
+    member_keys = json.loads(msg.keys)
+    shared = wire.Frame(groups.message_body(msg, username))
+    delivered = await groups.fan_out(
+        active_connections,
+        {
+            uid: shared.with_fields(key=member_keys.get(str(uid)))
+            for uid in member_names
+            if uid != user_id
+        },
+    )
+
+    with SessionLocal() as db:
+        groups.advance_cursors(db, group_id, delivered | {user_id}, msg.id)
+        db.commit()
+
+    await conn.send(
+        {
+            "type": "group_sent",
+            "id": msg.id,
+            "group_id": group_id,
+            "delivered_to": len(delivered),
+            "client_id": client_id,
+        }
+    )
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, token: str | None = None):
     """
@@ -680,249 +1301,271 @@ async def websocket_endpoint(websocket: WebSocket, token: str | None = None):
     Clients connect with:
       ws://127.0.0.1:8000/ws?token=YOUR_JWT_HERE
 
+    Frames are JSON text unless the client offers the "sandeshaa.msgpack"
+    subprotocol, in which case they are MessagePack with binary ciphertext
+    (see wire.py).
+
     After connecting, the server:
     - Authenticates the user via the JWT token
     - Sends any undelivered messages
-    - Listens for "send_message" events to route ciphertext messages
+    - Listens for "send_message" events to route ciphertext messages,
+      at most WS_RATE_PER_SECOND frames per second per connection
     """
-    # Accept connection first
-    await websocket.accept()
+    # Accept connection first, negotiating the frame encoding
+    conn = await wire.accept(websocket, max_frame_bytes=flowcontrol.WS_MAX_FRAME_BYTES)
 
     if token is None:
-        await websocket.send_json({"type": "error", "message": "Missing token"})
-        await websocket.close()
+        await conn.send({"type": "error", "message": "Missing token"})
+        await conn.close()
         return
 
-    db = SessionLocal()
+    # Decode and validate token
     try:
-        # Decode and validate token
-        try:
-            payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise JWTError()
-            # ensure int
-            user_id = int(user_id)
-        except JWTError:
-            await websocket.send_json({"type": "error", "message": "Invalid token"})
-            await websocket.close()
-            return
+        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+        user_id = payload.get("sub")
+        if user_id is None:
+            raise JWTError()
+        # ensure int
+        user_id = int(user_id)
+    except JWTError:
+        await conn.send({"type": "error", "message": "Invalid token"})
+        await conn.close()
+        return
 
+    # Sessions below are opened per operation, never for the life of the
+    # socket, so idle sockets don't each pin a pooled DB connection.
+    with SessionLocal() as db:
         user = db.query(models.User).filter(models.User.id == user_id).first()
-        if user is None:
-            await websocket.send_json({"type": "error", "message": "User not found"})
-            await websocket.close()
-            return
+        username = user.username if user else None
 
+    if username is None:
+        await conn.send({"type": "error", "message": "User not found"})
+        await conn.close()
+        return
+
+    try:
         # Register active connection
-        active_connections[user.id] = websocket
+        active_connections[user_id] = conn
 
         # --- Send any undelivered messages for this user ---
-        undelivered = (
-            db.query(models.Message)
-            .filter(
-                models.Message.to_user_id == user.id,
-                models.Message.delivered == False,
-            )
-            .order_by(models.Message.created_at.asc())
-            .all()
-        )
+        if offline_log.enabled:
+            undelivered, log_offset = await asyncio.to_thread(offline_log.read_pending, user_id)
+            with SessionLocal() as db:
+                # Skip anything removed since it was queued (cleanup, purge)
+                live_ids = set()
+                if undelivered:
+                    live_ids = {
+                        row.id
+                        for row in db.query(models.Message.id).filter(
+                            models.Message.id.in_([m.message_id for m in undelivered])
+                        )
+                    }
+                deleted_upto = tombstones.watermarks_for_user(db, user_id)
+            undelivered = [m for m in undelivered if m.message_id in live_ids]
+        else:
+            with SessionLocal() as db:
+                rows = (
+                    db.query(models.Message, models.User.username)
+                    .outerjoin(models.User, models.User.id == models.Message.from_user_id)
+                    .filter(
+                        models.Message.to_user_id == user_id,
+                        models.Message.delivered == False,
+                    )
+                    .order_by(models.Message.created_at.asc())
+                    .all()
+                )
+                deleted_upto = tombstones.watermarks_for_user(db, user_id)
+            undelivered = [
+                offline_log.PendingMessage(
+                    msg.id,
+                    msg.from_user_id,
+                    from_username,
+                    msg.created_at.isoformat() if msg.created_at else None,
+                    msg.ciphertext,
+                )
+                for msg, from_username in rows
+            ]
 
-        for msg in undelivered:
-            from_user = (
-                db.query(models.User)
-                .filter(models.User.id == msg.from_user_id)
-                .first()
-            )
-            await websocket.send_json(
+        # Messages in deleted conversations are never delivered
+        undelivered = [
+            m for m in undelivered
+            if not tombstones.is_hidden(deleted_upto, m.from_user_id, m.message_id)
+        ]
+
+        for m in undelivered:
+            await conn.send(
                 {
                     "type": "message",
-                    "id": msg.id,
-                    "from": from_user.username if from_user else None,
-                    "ciphertext": msg.ciphertext,
-                    "created_at": msg.created_at.isoformat()
-                    if msg.created_at
-                    else None,
+                    "id": m.message_id,
+                    "from": m.from_username,
+                    "ciphertext": m.ciphertext,
+                    "created_at": m.created_at,
                 }
             )
-            msg.delivered = True
 
-        db.commit()
+        if undelivered:
+            with SessionLocal() as db:
+                db.query(models.Message).filter(
+                    models.Message.id.in_([m.message_id for m in undelivered])
+                ).update({models.Message.delivered: True}, synchronize_session=False)
+                for m in undelivered:
+                    sync.record(db, sync.DELIVERED, [m.from_user_id], ref_id=m.message_id)
+                db.commit()
+
+        if offline_log.enabled:
+            await asyncio.to_thread(offline_log.ack, user_id, log_offset)
+
+        # --- Group messages past this user's delivery cursors ---
+        with SessionLocal() as db:
+            group_backlog = groups.pending_for_user(db, user_id)
+
+        for frame in group_backlog:
+            await conn.send(frame)
+
+        if group_backlog:
+            # group_id -> (first, last) id sent
+            sent = {}
+            for frame in group_backlog:
+                first_id, _ = sent.get(frame["group_id"], (frame["id"], None))
+                sent[frame["group_id"]] = (first_id, frame["id"])
+            with SessionLocal() as db:
+                for group_id, (first_id, message_id) in sent.items():
+                    groups.advance_cursors(db, group_id, [user_id], message_id, first_id=first_id)
+                db.commit()
 
         # --- Main receive loop for this WebSocket connection ---
+        # Rate limited per connection and scheduled fairly across
+        # connections, see flowcontrol.py
+        bucket = flowcontrol.TokenBucket()
         while True:
-            data = await websocket.receive_json()
+            try:
+                data = await conn.receive()
+                error = None
+            except wire.FrameTooLarge as e:
+                flow_metrics.record_oversized()
+                data, error = None, str(e)
+            except ValueError:
+                data, error = None, "Malformed frame"
+
+            # Rejected frames cost a token too
+            await flowcontrol.throttle(bucket)
+
+            if error:
+                await conn.send({"type": "error", "message": error})
+                continue
             msg_type = data.get("type")
 
-            if msg_type == "send_message":
-                client_id = data.get("client_id")
-                to_username = data.get("to")
-                ciphertext = data.get("ciphertext")
-
-                if not to_username or not ciphertext:
-                    await websocket.send_json(
-                        {
-                            "type": "error",
-                            "message": "Missing 'to' or 'ciphertext' in send_message",
-                        }
-                    )
-                    continue
+            async with frame_scheduler.turn() as slot:
+                if msg_type == "send_message":
+                    await send_direct_message(conn, user_id, username, data, slot)
+                elif msg_type == "send_group_message":
+                    await send_group_message(conn, user_id, username, data, slot)
 
-                # Find recipient user
-                to_user = (
-                    db.query(models.User)
-                    .filter(models.User.username == to_username)
-                    .first()
-                )
-                if not to_user:
-                    await websocket.send_json(
+                else:
+                    # Unknown message type
+                    await conn.send(
                         {
                             "type": "error",
-                            "message": f"Recipient '{to_username}' not found",
+                            "message": f"Unknown message type: {msg_type}",
                         }
                     )
-                    continue
-
-                # Save message in DB (encrypted ciphertext only)
-                new_msg = models.Message(
-                    from_user_id=user.id,
-                    to_user_id=to_user.id,
-                    ciphertext=ciphertext,
-                )
-
-                db.add(new_msg)
-                db.commit()
-                db.refresh(new_msg)
-
-                # Try to deliver in real-time if recipient is online
-                recipient_ws = active_connections.get(to_user.id)
-                if recipient_ws:
-                    try:
-                        await recipient_ws.send_json(
-                            {
-                                "type": "message",
-                                "id": new_msg.id,
-                                "from": user.username,
-                                "ciphertext": new_msg.ciphertext,
-                                "created_at": new_msg.created_at.isoformat()
-                                if new_msg.created_at
-                                else None,
-                            }
-                        )
-                        new_msg.delivered = True
-                        db.commit()
-                    except Exception:
-                        # If sending to recipient fails, keep it undelivered;
-                        # they'll fetch it next time they connect.
-                        pass
-
-                # Acknowledge to sender
-                await websocket.send_json(
-                    {
-                        "type": "sent",
-                        "id": new_msg.id,
-                        "to": to_username,
-                        "delivered": new_msg.delivered,
-                        "client_id": client_id,
-                    }
-                )
-
-            else:
-                # Unknown message type
-                await websocket.send_json(
-                    {
-                        "type": "error",
-                        "message": f"Unknown message type: {msg_type}",
-                    }
-                )
 
     except WebSocketDisconnect:
-        # Remove connection on disconnect
+        pass
+    finally:
+        # Remove connection on disconnect, or on any error that ends the
+        # handler, so a dead socket isn't left registered
         for uid, ws in list(active_connections.items()):
-            if ws is websocket:
+            if ws is conn:
                 del active_connections[uid]
                 break
-    finally:
-        db.close()
 
-# ----------------- AUTO-CLEANUP SCHEDULER ----------------- #
- # Auto-delete messages older than 7 days
-def cleanup_old_messages():
-    """Delete messages older than 7 days"""
-    db = SessionLocal()
-    try:
-        cutoff_date = datetime.now() - timedelta(days=7)
-        deleted_count = db.query(models.Message).filter(
-            models.Message.created_at < cutoff_date
-        ).delete()
-        db.commit()
-        
-        if deleted_count > 0:
-            print(f"✅ [AUTO-CLEANUP] Deleted {deleted_count} messages older than 7 days")
-        else:
-            print(f"ℹ️  [AUTO-CLEANUP] No old messages to delete")
-            
-    except Exception as e:
-        print(f"❌ [CLEANUP ERROR] {e}")
-        db.rollback()
-    finally:
-        db.close()
+# ----------------- BACKGROUND JOBS & CLEANUP SCHEDULER ----------------- #
+
+@job_queue.task("notify_user")
+async def notify_user(user_id: int, payload: dict):
+    """Push an event to a user's socket if they're online (best effort)."""
+    recipient_ws = active_connections.get(user_id)
+    if recipient_ws:
+        try:
+            await recipient_ws.send(payload)
+        except Exception as e:
+            print(f"Failed to notify recipient: {e}")
+
+
+@job_queue.task("notify_users")
+async def notify_users(user_ids: List[int], payload: dict):
+    """Push the same event to several users' sockets at once (best effort)."""
+    frame = wire.Frame(payload)
+    await groups.fan_out(active_connections, {user_id: frame for user_id in user_ids})
+
+
+# Conversation deletions waiting to be pushed: user_id -> peer usernames.
+# Several deletions made before the flush job runs go out as one frame.
+pending_deletion_events: Dict[int, set] = {}
+pending_deletion_lock = threading.Lock()
+
+
+def queue_deletion_event(user_id: int, peer_username: str):
+    with pending_deletion_lock:
+        peers = pending_deletion_events.setdefault(user_id, set())
+        first = not peers
+        peers.add(peer_username)
+    if first:
+        job_queue.enqueue("flush_deletion_events", user_id)
+
+
+@job_queue.task("flush_deletion_events")
+async def flush_deletion_events(user_id: int):
+    with pending_deletion_lock:
+        peers = pending_deletion_events.pop(user_id, set())
+    if peers:
+        await notify_user(user_id, {"type": "conversations_deleted", "with": sorted(peers)})
+
+
+# Create tables if they don't exist. This runs at startup rather than on
+# import, one worker at a time (init_db_serialized); set
+# AUTO_CREATE_TABLES=false and run `python init_db.py` once per deploy to
+# skip it entirely.
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES", "true").lower() in ("1", "true", "yes")
+
+
+@app.on_event("startup")
+async def create_tables():
+    if AUTO_CREATE_TABLES:
+        await asyncio.to_thread(init_db_serialized)
+
+
+# Set RUN_CLEANUP_IN_API=false when running worker.py alongside the API
+RUN_CLEANUP_IN_API = os.getenv("RUN_CLEANUP_IN_API", "true").lower() in ("1", "true", "yes")
+scheduler = tasks.create_scheduler() if RUN_CLEANUP_IN_API else None
 
-# Auto-delete files older than 24 hours
-def cleanup_old_files():
-    """Delete files older than 24 hours"""
-    db = SessionLocal()
-    try:
-        cutoff = datetime.now() - timedelta(hours=24)
-        
-        # Get old files
-        old_files = db.query(models.FileMessage).filter(
-            models.FileMessage.created_at < cutoff
-        ).all()
-        
-        # Delete physical files
-        deleted_count = 0
-        for file_msg in old_files:
-            file_path = UPLOAD_DIR / file_msg.stored_filename
-            if file_path.exists():
-                os.remove(file_path)
-                deleted_count += 1
-        
-        # Delete database records
-        db.query(models.FileMessage).filter(
-            models.FileMessage.created_at < cutoff
-        ).delete()
-        
-        db.commit()
-        
-        if deleted_count > 0:
-            print(f"✅ [FILE CLEANUP] Deleted {deleted_count} files older than 24 hours")
-        else:
-            print(f"ℹ️  [FILE CLEANUP] No old files to delete")
-            
-    except Exception as e:
-        print(f"❌ [FILE CLEANUP ERROR] {e}")
-        db.rollback()
-    finally:
-        db.close()
 
-# Initialize scheduler
-scheduler = BackgroundScheduler()
+@app.on_event("startup")
+async def start_background_jobs():
+    await job_queue.start()
+    if scheduler:
+        scheduler.start()
+        print("✅ Auto-cleanup scheduler started (messages: 7 days, files: 24 hours)")
 
-# Run message cleanup daily at 3:00 AM
-scheduler.add_job(cleanup_old_messages, 'cron', hour=3, minute=0, id='daily_cleanup')
 
-# Run file cleanup daily at 3:30 AM
-scheduler.add_job(cleanup_old_files, 'cron', hour=3, minute=30, id='file_cleanup')
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    if scheduler:
+        scheduler.shutdown()
+    await job_queue.stop()
 
-# Run both on startup
-scheduler.add_job(cleanup_old_messages, id='startup_cleanup')
-scheduler.add_job(cleanup_old_files, id='startup_file_cleanup')
 
-# Start scheduler
-scheduler.start()
+@app.get("/debug/jobs")
+def get_job_stats():
+    """Background job queue depth and counters."""
+    return job_queue.stats()
 
-# Shutdown gracefully
-atexit.register(lambda: scheduler.shutdown())
 
-print("✅ Auto-cleanup scheduler started (messages: 7 days, files: 24 hours)")
\ No newline at end of file
+@app.get("/debug/ws-flow")
+def get_ws_flow_stats():
+    """/ws frames throttled, refused for size, or queued for a handler turn."""
+    stats = flow_metrics.snapshot()
+    stats.update(frame_scheduler.stats())
+    stats["connections"] = len(active_connections)
+    return stats
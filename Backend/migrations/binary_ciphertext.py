@@ -0,0 +1,95 @@
+# migrations/binary_ciphertext.py
+"""
+Convert messages.ciphertext from base64 Text to packed LargeBinary.
+
+Run once from the Backend directory, with the server stopped:
+    python migrations/binary_ciphertext.py
+
+Steps:
+1. add a temporary binary column ciphertext_packed
+2. fill it in batches with ciphertext.pack(old text)
+3. drop the old column
+4. rename the new one into place and make it NOT NULL
+
+Each step checks the current columns before running, so an interrupted run
+can be resumed by running the script again. This matters on MySQL, where
+every ALTER commits on its own: a crash between 3 and 4 leaves only
+ciphertext_packed, and the next run picks up at the rename.
+
+Fresh databases don't need this; create_all already makes the binary column.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+
+from sqlalchemy import LargeBinary, inspect, text  # noqa: E402
+
+import ciphertext as ct  # noqa: E402
+from database import engine  # noqa: E402
+
+BATCH_SIZE = 1000
+TMP_COLUMN = "ciphertext_packed"
+
+
+def column_types() -> dict:
+    return {c["name"]: c["type"] for c in inspect(engine).get_columns("messages")}
+
+
+def main():
+    columns = column_types()
+    binary_type = LargeBinary().compile(dialect=engine.dialect)
+
+    if "ciphertext" in columns and TMP_COLUMN not in columns and isinstance(columns["ciphertext"], LargeBinary):
+        print("ℹ️  messages.ciphertext is already binary")
+    elif "ciphertext" in columns:
+        if TMP_COLUMN not in columns:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE messages ADD COLUMN {TMP_COLUMN} {binary_type}"))
+            print(f"✅ Added column {TMP_COLUMN}")
+
+        converted = 0
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(
+                    text(
+                        f"SELECT id, ciphertext FROM messages "
+                        f"WHERE {TMP_COLUMN} IS NULL ORDER BY id LIMIT :limit"
+                    ),
+                    {"limit": BATCH_SIZE},
+                ).all()
+                if not rows:
+                    break
+                conn.execute(
+                    text(f"UPDATE messages SET {TMP_COLUMN} = :packed WHERE id = :id"),
+                    [{"id": row.id, "packed": ct.pack(row.ciphertext)} for row in rows],
+                )
+            converted += len(rows)
+            print(f"   converted {converted} rows...")
+
+        # Only dropped once every row has its packed copy
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE messages DROP COLUMN ciphertext"))
+        print(f"✅ Dropped the old text column ({converted} rows converted)")
+
+    if TMP_COLUMN in column_types():
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE messages RENAME COLUMN {TMP_COLUMN} TO ciphertext"))
+        print(f"✅ Renamed {TMP_COLUMN} to ciphertext")
+
+    # Idempotent, so it also runs when a previous attempt stopped right before it.
+    # SQLite can't add NOT NULL after the fact; the ORM still enforces it
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE messages ALTER COLUMN ciphertext SET NOT NULL"))
+        elif engine.dialect.name == "mysql":
+            conn.execute(text(f"ALTER TABLE messages MODIFY ciphertext {binary_type} NOT NULL"))
+
+    print("✅ messages.ciphertext is binary")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# migrations/group_file_messages.py
+"""
+Add file_messages.group_id, for attachments shared with a group.
+
+Run once from the Backend directory:
+    python migrations/group_file_messages.py
+
+The group tables themselves (chat_groups, group_members, group_messages)
+are new and created by create_all / init_db.py. Fresh databases don't need
+this; create_all already makes the column. Safe to re-run.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+
+from sqlalchemy import inspect, text  # noqa: E402
+
+from database import engine  # noqa: E402
+from init_db import init_db  # noqa: E402
+
+
+def main():
+    init_db()
+
+    columns = {c["name"] for c in inspect(engine).get_columns("file_messages")}
+    if "group_id" in columns:
+        print("ℹ️  file_messages.group_id already exists, nothing to do")
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE file_messages ADD COLUMN group_id INTEGER REFERENCES chat_groups(id)"))
+    print("✅ Added column file_messages.group_id")
+
+
+if __name__ == "__main__":
+    main()
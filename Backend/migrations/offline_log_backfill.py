@@ -0,0 +1,69 @@
+# migrations/offline_log_backfill.py
+"""
+Queue every undelivered message into the offline log (offline_log.py).
+
+Run from the Backend directory with OFFLINE_LOG_DIR set, before starting the
+server with the log enabled for the first time (or to rebuild lost logs):
+    python migrations/offline_log_backfill.py
+
+Messages already in a recipient's log are skipped when the log is read, so
+re-running only costs disk space until the next delivery compacts it.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+
+import models  # noqa: E402
+import offline_log  # noqa: E402
+from database import SessionLocal  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+def main():
+    if not offline_log.enabled:
+        print("❌ OFFLINE_LOG_DIR is not set")
+        sys.exit(1)
+
+    queued = 0
+    last_id = 0
+    while True:
+        with SessionLocal() as db:
+            rows = (
+                db.query(models.Message, models.User.username)
+                .outerjoin(models.User, models.User.id == models.Message.from_user_id)
+                .filter(
+                    models.Message.delivered == False,
+                    models.Message.id > last_id,
+                )
+                .order_by(models.Message.id)
+                .limit(BATCH_SIZE)
+                .all()
+            )
+        if not rows:
+            break
+
+        for msg, from_username in rows:
+            offline_log.append(
+                msg.to_user_id,
+                offline_log.PendingMessage(
+                    msg.id,
+                    msg.from_user_id,
+                    from_username or "",
+                    msg.created_at.isoformat() if msg.created_at else None,
+                    msg.ciphertext,
+                ),
+            )
+        queued += len(rows)
+        last_id = rows[-1][0].id
+        print(f"  queued {queued} messages")
+
+    print(f"✅ Queued {queued} undelivered messages into {offline_log.OFFLINE_LOG_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# migrations/sync_events_autoincrement.py
+"""
+Rebuild sync_events with AUTOINCREMENT on SQLite.
+
+Run once from the Backend directory, with the server stopped:
+    python migrations/sync_events_autoincrement.py
+
+Without AUTOINCREMENT, SQLite hands out max(id) + 1, so after pruning
+deletes the newest events their ids (sync cursors clients may hold) get
+reused. SQLite can't alter that in place: the table is copied into a new
+one and swapped. Other databases already never reuse ids; nothing to do
+there. Safe to re-run.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+
+from sqlalchemy import text  # noqa: E402
+
+import models  # noqa: E402
+from database import engine  # noqa: E402
+from init_db import init_db  # noqa: E402
+
+TMP_TABLE = "sync_events_old"
+
+
+def main():
+    if engine.dialect.name != "sqlite":
+        print(f"ℹ️  {engine.dialect.name} doesn't reuse ids, nothing to do")
+        return
+
+    with engine.begin() as conn:
+        tables = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+        if TMP_TABLE not in tables:
+            sql = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'sync_events'")
+            ).scalar()
+            if sql is None or "AUTOINCREMENT" in sql.upper():
+                print("ℹ️  sync_events already uses AUTOINCREMENT (or doesn't exist yet), nothing to do")
+                return
+            conn.execute(text(f"ALTER TABLE sync_events RENAME TO {TMP_TABLE}"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_sync_events_user_id_id"))
+
+    # Creates the new sync_events (with AUTOINCREMENT) and its index
+    init_db()
+
+    with engine.begin() as conn:
+        columns = ", ".join(c.name for c in models.SyncEvent.__table__.columns)
+        conn.execute(text(f"INSERT INTO sync_events ({columns}) SELECT {columns} FROM {TMP_TABLE}"))
+        copied = conn.execute(text("SELECT count(*) FROM sync_events")).scalar()
+        conn.execute(text(f"DROP TABLE {TMP_TABLE}"))
+
+    print(f"✅ Rebuilt sync_events with AUTOINCREMENT ({copied} events copied)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, DateTime, Text, LargeBinary, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -22,7 +22,7 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)
     from_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     to_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    ciphertext = Column(Text, nullable=False)
+    ciphertext = Column(LargeBinary, nullable=False)  # packed bytes, see ciphertext.py
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     delivered = Column(Boolean, default=False, nullable=False)
 
@@ -38,6 +38,124 @@ class FileMessage(Base):
     file_size = Column(Integer)
     file_type = Column(String(100))                         # ✅ add length
     created_at = Column(DateTime, default=datetime.now)
+    group_id = Column(Integer, ForeignKey("chat_groups.id"), nullable=True)  # set instead of to_user_id for group files
 
     from_user = relationship("User", foreign_keys=[from_user_id])
     to_user = relationship("User", foreign_keys=[to_user_id])
+
+
+class SyncEvent(Base):
+    """
+    Per-user change log behind GET /sync. The autoincrement id is the sync
+    cursor; (user_id, id) is the index every sync reads. On SQLite it is a
+    real AUTOINCREMENT, so ids freed by pruning are never handed out again.
+    """
+    __tablename__ = "sync_events"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    kind = Column(String(32), nullable=False)     # message / file_message / delivered / conversation_deleted
+    ref_id = Column(Integer)                      # Message.id or FileMessage.id
+    peer_id = Column(Integer)                     # other user, for conversation events
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_sync_events_user_id_id", "user_id", "id"),
+        {"sqlite_autoincrement": True},
+    )
+
+
+class JobLease(Base):
+    """Time-limited lease so only one worker runs each scheduled job."""
+    __tablename__ = "job_leases"
+
+    name = Column(String(100), primary_key=True)
+    holder = Column(String(255), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class ConversationTombstone(Base):
+    """
+    Delete marker for a conversation. Rows between the two users with ids up
+    to the watermarks are hidden immediately and purged in the background.
+    """
+    __tablename__ = "conversation_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    user_a_id = Column(Integer, ForeignKey("users.id"), nullable=False)   # lower user id
+    user_b_id = Column(Integer, ForeignKey("users.id"), nullable=False)   # higher user id
+    message_watermark = Column(Integer, nullable=False, default=0)
+    file_watermark = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_conversation_tombstones_pair", "user_a_id", "user_b_id"),
+    )
+
+
+class UserUsage(Base):
+    """
+    Running totals of what each user has stored (as sender), kept in step
+    with inserts and deletes so quota checks are a primary-key lookup.
+    """
+    __tablename__ = "user_usage"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+    file_count = Column(Integer, nullable=False, default=0)
+    file_bytes = Column(BigInteger, nullable=False, default=0)
+
+
+class Counter(Base):
+    """Named global counters (e.g. "users"), so stats don't need COUNT(*)."""
+    __tablename__ = "counters"
+
+    name = Column(String(100), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+class Group(Base):
+    __tablename__ = "chat_groups"   # "groups" is reserved in MySQL 8
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), nullable=False)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class GroupMember(Base):
+    """
+    Membership plus a per-member delivery cursor: everything in the group
+    with id > last_delivered_id is still pending for that member, so one
+    stored GroupMessage serves every member.
+    """
+    __tablename__ = "group_members"
+
+    group_id = Column(Integer, ForeignKey("chat_groups.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    joined_after_id = Column(Integer, nullable=False, default=0)    # history starts after this GroupMessage.id
+    last_delivered_id = Column(Integer, nullable=False, default=0)
+    joined_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_group_members_user_id", "user_id"),
+    )
+
+
+class GroupMessage(Base):
+    """
+    One envelope per group message: the body encrypted once under a message
+    key, and that key wrapped for each member (keys, JSON user id -> key).
+    """
+    __tablename__ = "group_messages"
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey("chat_groups.id"), nullable=False)
+    from_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    ciphertext = Column(LargeBinary, nullable=False)  # packed bytes, see ciphertext.py
+    keys = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_group_messages_group_id_id", "group_id", "id"),
+    )
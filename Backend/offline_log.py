@@ -0,0 +1,269 @@
+# offline_log.py
+"""
+Optional append-only log of pending deliveries, one per recipient.
+
+When OFFLINE_LOG_DIR is set, a message whose recipient is offline is also
+appended to the recipient's log, and on connect the backlog is read from
+there instead of scanning messages on (to_user_id, delivered). The
+messages table stays the durable history; the log only holds what still
+has to go out.
+
+Layout, per recipient:
+
+    OFFLINE_LOG_DIR/<user_id>/<base offset>.seg   records
+    OFFLINE_LOG_DIR/<user_id>/cursor              delivered up to this offset
+
+Offsets are logical byte positions that keep growing across segments, so a
+segment's file name is the offset of its first byte and the cursor stays
+valid when delivered segments are deleted (compaction). Appends roll over
+to a new segment past OFFLINE_LOG_SEGMENT_BYTES. Reads mmap the segments
+after the cursor. A record torn by a crash mid-append is cut off the tail
+the next time the log is opened.
+
+Record: <body length u32><crc32 u32><body>, body =
+<message id i64><sender id i64><sender name len u16><created_at len u16>
+<sender name><created_at iso string><packed ciphertext>.
+
+Writes aren't fsync'd: a message lost from the log is still undelivered in
+the messages table, and migrations/offline_log_backfill.py rebuilds logs
+from it.
+
+Every function here does blocking file I/O and may wait on another
+process's flock, so async callers run them in a thread (asyncio.to_thread).
+Locks are per recipient: a slow log only holds up its own user.
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock applies
+    fcntl = None
+
+OFFLINE_LOG_DIR = os.getenv("OFFLINE_LOG_DIR", "")
+OFFLINE_LOG_SEGMENT_BYTES = int(os.getenv("OFFLINE_LOG_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+
+enabled = bool(OFFLINE_LOG_DIR)
+
+_RECORD_HEADER = struct.Struct("<II")
+_BODY_HEADER = struct.Struct("<qqHH")
+_SEGMENT_SUFFIX = ".seg"
+_CURSOR_FILE = "cursor"
+_LOCK_FILE = "lock"
+
+
+class PendingMessage(NamedTuple):
+    message_id: int
+    from_user_id: int
+    from_username: str
+    created_at: Optional[str]     # isoformat
+    ciphertext: bytes             # packed, see ciphertext.py
+
+
+class _Index:
+    """Where one recipient's log starts, ends and has been delivered up to."""
+
+    def __init__(self, segments: List[int], end: int, cursor: int, dir_mtime_ns: int):
+        self.segments = segments      # base offsets, ascending
+        self.end = end                # offset just past the last record
+        self.cursor = cursor          # everything before this was delivered
+        self.dir_mtime_ns = dir_mtime_ns
+
+
+_indexes: Dict[int, _Index] = {}
+_user_locks: Dict[int, threading.Lock] = {}
+_user_locks_guard = threading.Lock()
+
+
+def _user_lock(user_id: int) -> threading.Lock:
+    with _user_locks_guard:
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = _user_locks[user_id] = threading.Lock()
+        return lock
+
+
+def _user_dir(user_id: int) -> Path:
+    return Path(OFFLINE_LOG_DIR) / str(user_id)
+
+
+def _segment_path(user_id: int, base: int) -> Path:
+    return _user_dir(user_id) / f"{base:020d}{_SEGMENT_SUFFIX}"
+
+
+def _encode(message: PendingMessage) -> bytes:
+    name = message.from_username.encode()
+    created_at = (message.created_at or "").encode()
+    body = b"".join((
+        _BODY_HEADER.pack(message.message_id, message.from_user_id, len(name), len(created_at)),
+        name,
+        created_at,
+        message.ciphertext,
+    ))
+    return _RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def _decode(body: bytes) -> PendingMessage:
+    message_id, from_user_id, name_len, created_len = _BODY_HEADER.unpack_from(body)
+    pos = _BODY_HEADER.size
+    name = body[pos:pos + name_len].decode()
+    pos += name_len
+    created_at = body[pos:pos + created_len].decode()
+    pos += created_len
+    return PendingMessage(message_id, from_user_id, name, created_at or None, body[pos:])
+
+
+def _records(buf: mmap.mmap, start: int, stop: int) -> Iterator[Tuple[int, bytes]]:
+    """(record end, body) for each intact record in buf[start:stop]."""
+    pos = start
+    while pos + _RECORD_HEADER.size <= stop:
+        length, crc = _RECORD_HEADER.unpack_from(buf, pos)
+        body_start = pos + _RECORD_HEADER.size
+        body_end = body_start + length
+        if body_end > stop:
+            break
+        body = buf[body_start:body_end]
+        if zlib.crc32(body) != crc:
+            break
+        yield body_end, body
+        pos = body_end
+
+
+def _read_segment(path: Path, start: int, stop: int) -> List[PendingMessage]:
+    if stop <= start:
+        return []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return [_decode(body) for _, body in _records(buf, start, min(stop, len(buf)))]
+
+
+def _intact_length(path: Path) -> int:
+    size = path.stat().st_size
+    if size == 0:
+        return 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        good = 0
+        for good, _ in _records(buf, 0, size):
+            pass
+    return good
+
+
+def _load(user_id: int) -> _Index:
+    """Build the index from disk, cutting a torn record off the tail."""
+    user_dir = _user_dir(user_id)
+    segments = sorted(
+        int(name[:-len(_SEGMENT_SUFFIX)])
+        for name in os.listdir(user_dir)
+        if name.endswith(_SEGMENT_SUFFIX)
+    )
+    try:
+        cursor = int((user_dir / _CURSOR_FILE).read_text() or 0)
+    except FileNotFoundError:
+        cursor = 0
+
+    end = cursor
+    if segments:
+        last = _segment_path(user_id, segments[-1])
+        good = _intact_length(last)
+        if good < last.stat().st_size:
+            print(f"⚠️ [OFFLINE LOG] Truncating torn record in {last}")
+            os.truncate(last, good)
+        end = max(end, segments[-1] + good)
+
+    return _Index(segments, end, cursor, os.stat(user_dir).st_mtime_ns)
+
+
+@contextmanager
+def _locked(user_id: int) -> Iterator[_Index]:
+    """
+    The recipient's index, locked against this process (threads) and other
+    processes on the host (flock). The cached index is reloaded if another
+    process added or removed files, and its end refreshed from the active
+    segment's size.
+    """
+    user_dir = _user_dir(user_id)
+    with _user_lock(user_id):
+        user_dir.mkdir(parents=True, exist_ok=True)
+        with open(user_dir / _LOCK_FILE, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = _indexes.get(user_id)
+                if index is None or index.dir_mtime_ns != os.stat(user_dir).st_mtime_ns:
+                    index = _indexes[user_id] = _load(user_id)
+                elif index.segments:
+                    active = index.segments[-1]
+                    index.end = active + _segment_path(user_id, active).stat().st_size
+
+                yield index
+
+                index.dir_mtime_ns = os.stat(user_dir).st_mtime_ns
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def append(user_id: int, message: PendingMessage):
+    """Queue a message for delivery to user_id."""
+    record = _encode(message)
+    with _locked(user_id) as index:
+        if not index.segments or index.end - index.segments[-1] >= OFFLINE_LOG_SEGMENT_BYTES:
+            index.segments.append(index.end)
+        with open(_segment_path(user_id, index.segments[-1]), "ab") as f:
+            f.write(record)
+        index.end += len(record)
+
+
+def read_pending(user_id: int) -> Tuple[List[PendingMessage], int]:
+    """
+    Everything not yet delivered to user_id, oldest first, and the offset to
+    pass to ack() once it has been sent.
+    """
+    pending: List[PendingMessage] = []
+    seen = set()
+    with _locked(user_id) as index:
+        for i, base in enumerate(index.segments):
+            segment_end = index.segments[i + 1] if i + 1 < len(index.segments) else index.end
+            if segment_end <= index.cursor:
+                continue
+            messages = _read_segment(
+                _segment_path(user_id, base),
+                max(index.cursor - base, 0),
+                segment_end - base,
+            )
+            for message in messages:
+                # A backfill may have re-appended something already queued
+                if message.message_id not in seen:
+                    seen.add(message.message_id)
+                    pending.append(message)
+        return pending, index.end
+
+
+def ack(user_id: int, offset: int):
+    """
+    Mark everything before offset delivered, and compact: segments that are
+    entirely delivered are deleted.
+    """
+    with _locked(user_id) as index:
+        if offset <= index.cursor:
+            return
+        index.cursor = offset
+
+        cursor_path = _user_dir(user_id) / _CURSOR_FILE
+        tmp_path = cursor_path.with_suffix(".tmp")
+        tmp_path.write_text(str(offset))
+        os.replace(tmp_path, cursor_path)
+
+        keep = []
+        for i, base in enumerate(index.segments):
+            segment_end = index.segments[i + 1] if i + 1 < len(index.segments) else index.end
+            if segment_end <= offset:
+                os.remove(_segment_path(user_id, base))
+            else:
+                keep.append(base)
+        index.segments = keep
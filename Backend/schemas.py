@@ -1,4 +1,6 @@
 # schemas.py
+from typing import List
+
 from pydantic import BaseModel
 
 
@@ -25,6 +27,31 @@ class PublicKeysResponse(BaseModel):
     prekey_public: str
 
 
+class BulkKeysRequest(BaseModel):
+    usernames: List[str]
+
+
+class BulkKeysResponse(BaseModel):
+    keys: List[PublicKeysResponse]
+    missing: List[str]
+
+
+class CreateGroupRequest(BaseModel):
+    name: str
+    members: List[str]      # usernames, the creator is added automatically
+
+
+class GroupMembersRequest(BaseModel):
+    usernames: List[str]
+
+
+class GroupResponse(BaseModel):
+    id: int
+    name: str
+    created_by: str
+    members: List[str]
+
+
 class UserInfoResponse(BaseModel):
     id: int
     username: str
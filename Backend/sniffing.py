@@ -0,0 +1,120 @@
+# sniffing.py
+"""
+Content validation for uploads using magic bytes.
+
+Only the first SNIFF_BYTES of an upload are inspected, in a small thread
+pool so libmagic never runs on the event loop. Each pool thread keeps one
+libmagic handle (handles aren't thread-safe, and opening one loads the whole
+magic database, which is the expensive part).
+
+Web and mobile clients encrypt files before upload into a JSON envelope
+({"v":1,"nonce":...,"box":...}), so that is accepted as-is; anything else
+must look like what its extension claims.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import magic
+except ImportError:  # python-magic (libmagic) is optional
+    magic = None
+
+SNIFF_BYTES = 2048
+
+# Client-side encryption envelope (see Frontend/src/crypto.js encryptFile)
+ENCRYPTED_ENVELOPE_PREFIX = b'{"v":1,'
+
+# Extension -> MIME types its content may sniff as
+ALLOWED_MIME_TYPES = {
+    # Images
+    '.jpg': frozenset({'image/jpeg'}),
+    '.jpeg': frozenset({'image/jpeg'}),
+    '.png': frozenset({'image/png'}),
+    '.gif': frozenset({'image/gif'}),
+    '.webp': frozenset({'image/webp'}),
+    '.bmp': frozenset({'image/bmp', 'image/x-ms-bmp'}),
+    '.svg': frozenset({'image/svg+xml', 'text/xml', 'text/plain'}),
+
+    # Documents
+    '.pdf': frozenset({'application/pdf'}),
+    '.doc': frozenset({'application/msword', 'application/x-ole-storage', 'application/CDFV2'}),
+    '.docx': frozenset({'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/zip'}),
+    '.txt': frozenset({'text/plain'}),
+    '.rtf': frozenset({'application/rtf', 'text/rtf'}),
+    '.odt': frozenset({'application/vnd.oasis.opendocument.text', 'application/zip'}),
+
+    # Spreadsheets
+    '.xls': frozenset({'application/vnd.ms-excel', 'application/x-ole-storage', 'application/CDFV2'}),
+    '.xlsx': frozenset({'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/zip'}),
+    '.csv': frozenset({'text/csv', 'text/plain'}),
+    '.ods': frozenset({'application/vnd.oasis.opendocument.spreadsheet', 'application/zip'}),
+
+    # Presentations
+    '.ppt': frozenset({'application/vnd.ms-powerpoint', 'application/x-ole-storage', 'application/CDFV2'}),
+    '.pptx': frozenset({'application/vnd.openxmlformats-officedocument.presentationml.presentation', 'application/zip'}),
+    '.odp': frozenset({'application/vnd.oasis.opendocument.presentation', 'application/zip'}),
+
+    # Archives
+    '.zip': frozenset({'application/zip'}),
+    '.rar': frozenset({'application/x-rar', 'application/x-rar-compressed', 'application/vnd.rar'}),
+    '.7z': frozenset({'application/x-7z-compressed'}),
+
+    # Media
+    '.mp3': frozenset({'audio/mpeg'}),
+    '.mp4': frozenset({'video/mp4'}),
+    '.wav': frozenset({'audio/wav', 'audio/x-wav'}),
+    '.avi': frozenset({'video/x-msvideo'}),
+    '.mov': frozenset({'video/quicktime'}),
+}
+
+# Block executable files by magic bytes whatever their extension
+DANGEROUS_MIME_TYPES = (
+    'application/x-executable',
+    'application/x-dosexec',
+    'application/x-msdownload',
+    'application/x-msdos-program',
+    'application/x-sharedlib',
+    'application/x-mach-binary',
+    'application/x-sh',
+    'application/x-shellscript',
+)
+
+_local = threading.local()
+sniff_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sniff")
+
+
+def _magic_handle():
+    handle = getattr(_local, "handle", None)
+    if handle is None:
+        handle = _local.handle = magic.Magic(mime=True)
+    return handle
+
+
+def detect_mime(header: bytes) -> str:
+    return _magic_handle().from_buffer(header)
+
+
+def sniff_content(header: bytes, file_ext: str) -> tuple[bool, str]:
+    """Check the first chunk of an upload against its extension."""
+    if header.startswith(ENCRYPTED_ENVELOPE_PREFIX):
+        return True, "OK"
+
+    if magic is None:
+        return True, "OK"
+
+    try:
+        detected_mime = detect_mime(header)
+    except Exception as e:
+        # Don't fail uploads if libmagic itself has issues, just log
+        print(f"⚠️ Magic byte validation warning: {e}")
+        return True, "OK"
+
+    if detected_mime.startswith(DANGEROUS_MIME_TYPES):
+        return False, "Executable files are not allowed"
+
+    expected_mimes = ALLOWED_MIME_TYPES.get(file_ext)
+    if expected_mimes and detected_mime not in expected_mimes:
+        print(f"❌ MIME mismatch! Extension says {file_ext}, but content is {detected_mime}")
+        return False, f"File type mismatch! File extension is {file_ext} but content appears to be {detected_mime}. Possible spoofing attempt."
+
+    return True, "OK"
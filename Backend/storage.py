@@ -0,0 +1,63 @@
+# storage.py
+import os
+from pathlib import Path
+from urllib.parse import quote
+
+from fastapi.responses import FileResponse, Response
+
+# Where uploaded (client-encrypted) files are kept
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "uploads"))
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+# How /download-file hands over the bytes once the request is authorized:
+#   app              - the worker sends the file itself (FileResponse). ASGI
+#                      servers offering the http.response.pathsend extension
+#                      (e.g. Granian) sendfile() it; uvicorn streams chunks.
+#   x-accel-redirect - an empty response; nginx serves the file from the
+#                      internal location DOWNLOAD_ACCEL_PREFIX maps to UPLOAD_DIR.
+#   x-sendfile       - an empty response; Apache (mod_xsendfile) or lighttpd
+#                      serve the file by its absolute path.
+DOWNLOAD_MODES = ("app", "x-accel-redirect", "x-sendfile")
+DOWNLOAD_MODE = os.getenv("DOWNLOAD_MODE", "app").lower()
+DOWNLOAD_ACCEL_PREFIX = os.getenv("DOWNLOAD_ACCEL_PREFIX", "/protected-uploads/")
+
+if DOWNLOAD_MODE not in DOWNLOAD_MODES:
+    raise RuntimeError(f"DOWNLOAD_MODE must be one of {', '.join(DOWNLOAD_MODES)}")
+
+
+def upload_path(stored_filename: str) -> Path:
+    return UPLOAD_DIR / stored_filename
+
+
+def delete_upload(stored_filename: str) -> bool:
+    """Remove a stored file. Returns False if it was already gone."""
+    try:
+        os.remove(upload_path(stored_filename))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _content_disposition(filename: str) -> str:
+    # Same form FileResponse uses, so offloaded downloads save under the same name
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def download_response(stored_filename: str, filename: str) -> Response:
+    """The response for an authorized download, according to DOWNLOAD_MODE."""
+    if DOWNLOAD_MODE == "app":
+        return FileResponse(
+            path=upload_path(stored_filename),
+            filename=filename,
+            media_type="application/octet-stream",
+        )
+
+    headers = {"Content-Disposition": _content_disposition(filename)}
+    if DOWNLOAD_MODE == "x-accel-redirect":
+        headers["X-Accel-Redirect"] = DOWNLOAD_ACCEL_PREFIX.rstrip("/") + "/" + quote(stored_filename)
+    else:
+        headers["X-Sendfile"] = str(upload_path(stored_filename).resolve())
+    return Response(headers=headers, media_type="application/octet-stream")
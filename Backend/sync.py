@@ -0,0 +1,197 @@
+# sync.py
+"""
+Delta sync: every change a client needs to reconcile (new messages, new
+files, delivery receipts, deleted conversations) is appended to the
+sync_events table for each user it affects. GET /sync?since=<cursor> then
+replays one user's events after the cursor as NDJSON, one line per event.
+Group conversations aren't covered: a group message is stored once, not as
+an event per member, and clients page through
+GET /groups/{id}/messages?after_id= instead.
+
+Event ids come from an autoincrement, which is not commit order: with
+concurrent transactions a lower id can become visible after a higher one
+was already read. So the cursor handed back never moves past an event
+younger than SYNC_SETTLE_SECONDS (by the database clock). Such events are
+still sent, and sent again by the next sync; clients apply them by id, so
+the repeat is harmless. This assumes transactions that record events finish
+within SYNC_SETTLE_SECONDS of starting, which the short per-message commits
+here do.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import ciphertext as ct
+import fastjson
+import models
+import tombstones
+from database import SessionLocal
+
+MESSAGE = "message"
+FILE_MESSAGE = "file_message"
+DELIVERED = "delivered"
+CONVERSATION_DELETED = "conversation_deleted"
+
+SYNC_BATCH_SIZE = 500
+SYNC_RETENTION = timedelta(days=7)  # same as message retention
+SYNC_SETTLE_SECONDS = float(os.getenv("SYNC_SETTLE_SECONDS", "5"))
+
+
+def record(db: Session, kind: str, user_ids: Iterable[int], ref_id: int | None = None, peer_id: int | None = None):
+    """Add an event for each user; committed with the caller's transaction."""
+    for user_id in set(user_ids):
+        db.add(models.SyncEvent(user_id=user_id, kind=kind, ref_id=ref_id, peer_id=peer_id))
+
+
+def prune(db: Session) -> int:
+    """Drop events past retention. Clients older than that get reset=true."""
+    cutoff = datetime.now() - SYNC_RETENTION
+    return db.query(models.SyncEvent).filter(models.SyncEvent.created_at < cutoff).delete()
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def _events_after(db: Session, user_id: int, cursor: int, limit: int):
+    return (
+        db.query(models.SyncEvent)
+        .filter(models.SyncEvent.user_id == user_id, models.SyncEvent.id > cursor)
+        .order_by(models.SyncEvent.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+def _serialize_batch(db: Session, user_id: int, events, usernames: dict, deleted_upto: dict, cursors: dict) -> Iterator[dict]:
+    message_ids = [e.ref_id for e in events if e.kind == MESSAGE]
+    file_ids = [e.ref_id for e in events if e.kind == FILE_MESSAGE]
+
+    messages = {}
+    if message_ids:
+        for m in db.query(models.Message).filter(models.Message.id.in_(message_ids)):
+            messages[m.id] = m
+    files = {}
+    if file_ids:
+        for f in db.query(models.FileMessage).filter(models.FileMessage.id.in_(file_ids)):
+            files[f.id] = f
+
+    # Resolve any usernames not seen in earlier batches in one query
+    wanted = set()
+    for m in messages.values():
+        wanted.update((m.from_user_id, m.to_user_id))
+    for f in files.values():
+        wanted.update((f.from_user_id, f.to_user_id))
+    wanted.update(e.peer_id for e in events if e.peer_id is not None)
+    wanted -= usernames.keys()
+    if wanted:
+        for uid, username in db.query(models.User.id, models.User.username).filter(models.User.id.in_(wanted)):
+            usernames[uid] = username
+
+    for event in events:
+        if event.kind == MESSAGE:
+            m = messages.get(event.ref_id)
+            if m is None:
+                continue  # deleted since; a later event says so
+            peer_id = m.to_user_id if m.from_user_id == user_id else m.from_user_id
+            if tombstones.is_hidden(deleted_upto, peer_id, m.id):
+                continue  # conversation deleted, purge still pending
+            yield {
+                "type": MESSAGE,
+                "cursor": cursors[event.id],
+                "id": m.id,
+                "from": usernames.get(m.from_user_id),
+                "to": usernames.get(m.to_user_id),
+                "ciphertext": ct.unpack(m.ciphertext),
+                "created_at": _isoformat(m.created_at),
+                "delivered": m.delivered,
+            }
+        elif event.kind == FILE_MESSAGE:
+            f = files.get(event.ref_id)
+            if f is None:
+                continue
+            peer_id = f.to_user_id if f.from_user_id == user_id else f.from_user_id
+            if tombstones.is_hidden(deleted_upto, peer_id, f.id, files=True):
+                continue
+            yield {
+                "type": FILE_MESSAGE,
+                "cursor": cursors[event.id],
+                "id": f.id,
+                "file_id": f.id,
+                "from": usernames.get(f.from_user_id),
+                "to": usernames.get(f.to_user_id),
+                "filename": f.filename,
+                "file_size": f.file_size,
+                "file_type": f.file_type,
+                "created_at": _isoformat(f.created_at),
+            }
+        elif event.kind == DELIVERED:
+            yield {"type": DELIVERED, "cursor": cursors[event.id], "id": event.ref_id}
+        elif event.kind == CONVERSATION_DELETED:
+            yield {
+                "type": CONVERSATION_DELETED,
+                "cursor": cursors[event.id],
+                "with": usernames.get(event.peer_id),
+            }
+
+
+def stream_changes(user_id: int, since: int, limit: int) -> Iterator[str]:
+    """
+    NDJSON lines for the user's events after `since`, at most `limit`
+    events, read in batches so large gaps never materialize at once. The
+    last line is {"type": "end", "cursor": ..., "has_more": ..., "reset": ...};
+    reset=true means the cursor predates retention and the client should
+    reload history instead.
+
+    Each line's cursor (and the end cursor) stops at the last settled event
+    before the first unsettled one, see the module docstring.
+    """
+    with SessionLocal() as db:
+        reset = False
+        if since > 0:
+            # A cursor is always one of this user's event ids. Pruning
+            # removes events oldest-first, so if that event is gone, later
+            # ones may be too.
+            reset = db.query(models.SyncEvent.id).filter(
+                models.SyncEvent.user_id == user_id,
+                models.SyncEvent.id == since,
+            ).first() is None
+
+        settled_before = db.query(func.now()).scalar() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+        read_cursor = since    # where the next batch starts
+        cursor = since         # what the client may resume from
+        settled = True
+        remaining = limit
+        usernames: dict = {}
+        deleted_upto = tombstones.watermarks_for_user(db, user_id)
+        has_more = False
+
+        while remaining > 0:
+            events = _events_after(db, user_id, read_cursor, min(SYNC_BATCH_SIZE, remaining))
+            if not events:
+                break
+            cursors = {}
+            for event in events:
+                settled = settled and _settled(event.created_at, settled_before)
+                if settled:
+                    cursor = event.id
+                cursors[event.id] = cursor
+            for item in _serialize_batch(db, user_id, events, usernames, deleted_upto, cursors):
+                yield fastjson.dumps_str(item) + "\n"
+            read_cursor = events[-1].id
+            remaining -= len(events)
+        else:
+            has_more = bool(_events_after(db, user_id, read_cursor, 1))
+
+    yield fastjson.dumps_str({"type": "end", "cursor": cursor, "has_more": has_more, "reset": reset}) + "\n"
+
+
+def _settled(created_at, settled_before) -> bool:
+    # SQLite hands back naive UTC, Postgres aware values; compare like with like
+    if (created_at.tzinfo is None) != (settled_before.tzinfo is None):
+        created_at = created_at.replace(tzinfo=settled_before.tzinfo)
+    return created_at < settled_before
+
@@ -0,0 +1,244 @@
+# tasks.py
+"""
+Background jobs that don't need the web app: scheduled cleanup and file
+deletion. They run on the job queue, either inside the API process or in
+the separate worker (worker.py). Scheduled cleanups are leader-elected
+(leader.py), so running several workers doesn't multiply them.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy import delete
+
+from database import SessionLocal
+from jobs import job_queue
+from leader import run_as_leader
+from storage import delete_upload
+import models
+import sync
+import tombstones
+import usage
+
+
+# A cleanup run holds its lease this long, so with N workers firing the same
+# trigger only one of them runs it
+CLEANUP_LEASE_TTL = timedelta(minutes=10)
+
+
+def _delete_returning(db, model, condition, *columns):
+    """
+    Delete the rows matching condition and return `columns` of the rows this
+    transaction actually deleted. Usage is released from these, not from an
+    earlier SELECT, so a purge and a cleanup deleting the same rows at the
+    same time can't both release them.
+    """
+    if db.get_bind().dialect.delete_returning:
+        return db.execute(delete(model).where(condition).returning(*columns)).all()
+
+    # No DELETE ... RETURNING (MySQL): delete row by row, keep the ones that hit
+    deleted = []
+    for row in db.query(model.id, *columns).filter(condition).all():
+        if db.query(model).filter(model.id == row.id).delete(synchronize_session=False):
+            deleted.append(row)
+    return deleted
+
+
+def _release_messages(db, senders):
+    """Drop usage counters for deleted messages, given each row's sender id."""
+    for user_id, count in Counter(senders).items():
+        usage.release(db, user_id, messages=count)
+
+
+def _release_files(db, rows):
+    """Drop usage counters for deleted file rows (from_user_id, file_size)."""
+    totals = defaultdict(lambda: [0, 0])
+    for row in rows:
+        totals[row.from_user_id][0] += 1
+        totals[row.from_user_id][1] += row.file_size or 0
+    for user_id, (count, size) in totals.items():
+        usage.release(db, user_id, files=count, file_bytes=size)
+
+
+# Auto-delete messages older than 7 days
+@job_queue.task("cleanup_old_messages")
+@run_as_leader("cleanup_old_messages", CLEANUP_LEASE_TTL)
+def cleanup_old_messages():
+    """Delete messages older than 7 days"""
+    db = SessionLocal()
+    try:
+        cutoff_date = datetime.now() - timedelta(days=7)
+
+        # Usage counters drop with the rows, in the same transaction
+        deleted = _delete_returning(
+            db, models.Message, models.Message.created_at < cutoff_date, models.Message.from_user_id
+        )
+        # Group messages follow the same retention
+        deleted += _delete_returning(
+            db, models.GroupMessage, models.GroupMessage.created_at < cutoff_date, models.GroupMessage.from_user_id
+        )
+        _release_messages(db, [row.from_user_id for row in deleted])
+        deleted_count = len(deleted)
+        sync.prune(db)
+        db.commit()
+
+        requeue_pending_purges()
+
+        if deleted_count > 0:
+            print(f"✅ [AUTO-CLEANUP] Deleted {deleted_count} messages older than 7 days")
+        else:
+            print(f"ℹ️  [AUTO-CLEANUP] No old messages to delete")
+
+    except Exception as e:
+        print(f"❌ [CLEANUP ERROR] {e}")
+        db.rollback()
+        raise  # let the job queue retry with backoff
+    finally:
+        db.close()
+
+
+# Auto-delete files older than 24 hours
+@job_queue.task("cleanup_old_files")
+@run_as_leader("cleanup_old_files", CLEANUP_LEASE_TTL)
+def cleanup_old_files():
+    """Delete files older than 24 hours"""
+    db = SessionLocal()
+    try:
+        cutoff = datetime.now() - timedelta(hours=24)
+
+        # Delete database records first, so nothing points at a missing file
+        old_files = _delete_returning(
+            db,
+            models.FileMessage,
+            models.FileMessage.created_at < cutoff,
+            models.FileMessage.stored_filename,
+            models.FileMessage.from_user_id,
+            models.FileMessage.file_size,
+        )
+        stored_filenames = [row.stored_filename for row in old_files]
+        _release_files(db, old_files)
+
+        db.commit()
+
+        # Physical files are removed by their own (retried) jobs
+        for stored_filename in stored_filenames:
+            job_queue.enqueue("delete_upload", stored_filename)
+
+        if stored_filenames:
+            print(f"✅ [FILE CLEANUP] Deleting {len(stored_filenames)} files older than 24 hours")
+        else:
+            print(f"ℹ️  [FILE CLEANUP] No old files to delete")
+
+    except Exception as e:
+        print(f"❌ [FILE CLEANUP ERROR] {e}")
+        db.rollback()
+        raise  # let the job queue retry with backoff
+    finally:
+        db.close()
+
+
+job_queue.task("delete_upload")(delete_upload)
+
+
+PURGE_BATCH_SIZE = 1000
+
+
+@job_queue.task("purge_conversation")
+def purge_conversation(tombstone_id: int):
+    """
+    Remove the rows hidden by a tombstone in batches of PURGE_BATCH_SIZE,
+    one short transaction each, then drop the tombstone. Safe to re-run.
+    """
+    with SessionLocal() as db:
+        tombstone = db.get(models.ConversationTombstone, tombstone_id)
+        if tombstone is None:
+            return
+        user_a_id, user_b_id = tombstone.user_a_id, tombstone.user_b_id
+        message_watermark, file_watermark = tombstone.message_watermark, tombstone.file_watermark
+
+    purged_messages = 0
+    while True:
+        with SessionLocal() as db:
+            rows = (
+                db.query(models.Message.id, models.Message.from_user_id)
+                .filter(
+                    tombstones.pair_filter(models.Message, user_a_id, user_b_id),
+                    models.Message.id <= message_watermark,
+                )
+                .limit(PURGE_BATCH_SIZE)
+                .all()
+            )
+            if not rows:
+                break
+            deleted = _delete_returning(
+                db, models.Message, models.Message.id.in_([row.id for row in rows]), models.Message.from_user_id
+            )
+            _release_messages(db, [row.from_user_id for row in deleted])
+            db.commit()
+        purged_messages += len(deleted)
+
+    purged_files = 0
+    while True:
+        with SessionLocal() as db:
+            rows = (
+                db.query(
+                    models.FileMessage.id,
+                    models.FileMessage.stored_filename,
+                    models.FileMessage.from_user_id,
+                    models.FileMessage.file_size,
+                )
+                .filter(
+                    tombstones.pair_filter(models.FileMessage, user_a_id, user_b_id),
+                    models.FileMessage.id <= file_watermark,
+                )
+                .limit(PURGE_BATCH_SIZE)
+                .all()
+            )
+            if not rows:
+                break
+            deleted = _delete_returning(
+                db,
+                models.FileMessage,
+                models.FileMessage.id.in_([row.id for row in rows]),
+                models.FileMessage.stored_filename,
+                models.FileMessage.from_user_id,
+                models.FileMessage.file_size,
+            )
+            _release_files(db, deleted)
+            db.commit()
+        for row in deleted:
+            job_queue.enqueue("delete_upload", row.stored_filename)
+        purged_files += len(deleted)
+
+    with SessionLocal() as db:
+        db.query(models.ConversationTombstone).filter(
+            models.ConversationTombstone.id == tombstone_id
+        ).delete(synchronize_session=False)
+        db.commit()
+
+    print(f"✅ [PURGE] Conversation {user_a_id}<->{user_b_id}: {purged_messages} messages, {purged_files} files")
+
+
+def requeue_pending_purges():
+    """Re-enqueue purges whose job was lost (queue full, restart)."""
+    with SessionLocal() as db:
+        tombstone_ids = [row.id for row in db.query(models.ConversationTombstone.id)]
+    for tombstone_id in tombstone_ids:
+        job_queue.enqueue("purge_conversation", tombstone_id)
+
+
+def create_scheduler() -> AsyncIOScheduler:
+    """Cleanup schedule; the scheduler only enqueues, the job queue does the work."""
+    scheduler = AsyncIOScheduler()
+
+    # Run message cleanup daily at 3:00 AM
+    scheduler.add_job(job_queue.enqueue, 'cron', args=['cleanup_old_messages'], hour=3, minute=0, id='daily_cleanup')
+
+    # Run file cleanup daily at 3:30 AM
+    scheduler.add_job(job_queue.enqueue, 'cron', args=['cleanup_old_files'], hour=3, minute=30, id='file_cleanup')
+
+    # Run both on startup
+    scheduler.add_job(job_queue.enqueue, args=['cleanup_old_messages'], id='startup_cleanup')
+    scheduler.add_job(job_queue.enqueue, args=['cleanup_old_files'], id='startup_file_cleanup')
+
+    return scheduler
@@ -0,0 +1,96 @@
+# tombstones.py
+"""
+Conversation deletion via tombstones.
+
+Deleting a conversation only inserts a ConversationTombstone holding the
+pair's current max Message / FileMessage ids. Every read path hides rows of
+that pair at or below the watermarks, and the purge job in tasks.py removes
+the rows and their files in bounded batches afterwards.
+
+The watermarks are the pair's own max ids, not the tables' global max: a
+message of this pair still being committed when the delete runs has a
+higher id than anything of the pair already visible, so it stays visible.
+"""
+from typing import Dict, Tuple
+
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import Session
+
+import models
+
+
+def _pair(user_id: int, other_id: int) -> Tuple[int, int]:
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+
+def _newly_covered(db: Session, model, user_id: int, other_id: int, after_id: int) -> Tuple[int, int]:
+    """(max id, count) of the pair's rows above after_id that are visible now."""
+    max_id, count = db.query(func.max(model.id), func.count(model.id)).filter(
+        pair_filter(model, user_id, other_id),
+        model.id > after_id,
+    ).one()
+    return max_id or after_id, count
+
+
+def create(db: Session, user_id: int, other_id: int) -> Tuple[models.ConversationTombstone, int]:
+    """
+    Add a tombstone covering everything the pair has exchanged so far.
+    Returns it with the number of messages it newly hides.
+    """
+    user_a_id, user_b_id = _pair(user_id, other_id)
+    message_after, file_after = watermarks(db, user_id, other_id)
+    message_watermark, message_count = _newly_covered(db, models.Message, user_id, other_id, message_after)
+    file_watermark, _ = _newly_covered(db, models.FileMessage, user_id, other_id, file_after)
+    tombstone = models.ConversationTombstone(
+        user_a_id=user_a_id,
+        user_b_id=user_b_id,
+        message_watermark=message_watermark,
+        file_watermark=file_watermark,
+    )
+    db.add(tombstone)
+    return tombstone, message_count
+
+
+def watermarks(db: Session, user_id: int, other_id: int) -> Tuple[int, int]:
+    """(message_watermark, file_watermark) for a pair; (0, 0) if not deleted."""
+    user_a_id, user_b_id = _pair(user_id, other_id)
+    row = db.query(
+        func.max(models.ConversationTombstone.message_watermark),
+        func.max(models.ConversationTombstone.file_watermark),
+    ).filter(
+        models.ConversationTombstone.user_a_id == user_a_id,
+        models.ConversationTombstone.user_b_id == user_b_id,
+    ).one()
+    return row[0] or 0, row[1] or 0
+
+
+def watermarks_for_user(db: Session, user_id: int) -> Dict[int, Tuple[int, int]]:
+    """Watermarks for every pending tombstone involving user_id, keyed by peer id."""
+    rows = db.query(models.ConversationTombstone).filter(
+        or_(
+            models.ConversationTombstone.user_a_id == user_id,
+            models.ConversationTombstone.user_b_id == user_id,
+        )
+    ).all()
+
+    result: Dict[int, Tuple[int, int]] = {}
+    for t in rows:
+        peer_id = t.user_b_id if t.user_a_id == user_id else t.user_a_id
+        msg_wm, file_wm = result.get(peer_id, (0, 0))
+        result[peer_id] = (max(msg_wm, t.message_watermark), max(file_wm, t.file_watermark))
+    return result
+
+
+def is_hidden(marks: Dict[int, Tuple[int, int]], peer_id: int, row_id: int, files: bool = False) -> bool:
+    """Whether a row exchanged with peer_id is covered by a tombstone in `marks`."""
+    if peer_id not in marks:
+        return False
+    return row_id <= marks[peer_id][1 if files else 0]
+
+
+def pair_filter(model, user_id: int, other_id: int):
+    """Both directions of a conversation for Message or FileMessage."""
+    return or_(
+        and_(model.from_user_id == user_id, model.to_user_id == other_id),
+        and_(model.from_user_id == other_id, model.to_user_id == user_id),
+    )
@@ -0,0 +1,142 @@
+# usage.py
+"""
+Per-user storage / message counters and the quotas checked against them.
+
+Counters are adjusted in the same transaction as the rows they count
+(send, upload, cleanup, conversation purge), so a quota check is one
+primary-key lookup instead of a COUNT/SUM over messages or files. Usage is
+charged to the sender. Users created before the user_usage table existed
+get their row computed from the tables the first time it's read.
+"""
+import os
+
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+# 0 disables a quota
+USER_STORAGE_QUOTA_BYTES = int(os.getenv("USER_STORAGE_QUOTA_MB", "500")) * 1024 * 1024
+USER_MESSAGE_QUOTA = int(os.getenv("USER_MESSAGE_QUOTA", "100000"))
+
+USERS_COUNTER = "users"
+
+
+def _recount(db: Session, user_id: int) -> models.UserUsage:
+    message_count = db.query(func.count(models.Message.id)).filter(
+        models.Message.from_user_id == user_id
+    ).scalar() + db.query(func.count(models.GroupMessage.id)).filter(
+        models.GroupMessage.from_user_id == user_id
+    ).scalar()
+    file_count, file_bytes = db.query(
+        func.count(models.FileMessage.id),
+        func.coalesce(func.sum(models.FileMessage.file_size), 0),
+    ).filter(models.FileMessage.from_user_id == user_id).one()
+    return models.UserUsage(
+        user_id=user_id,
+        message_count=message_count,
+        file_count=file_count,
+        file_bytes=file_bytes,
+    )
+
+
+def create(db: Session, user_id: int):
+    """Empty counters for a newly registered user."""
+    db.add(models.UserUsage(user_id=user_id, message_count=0, file_count=0, file_bytes=0))
+    increment(db, USERS_COUNTER)
+
+
+def get(db: Session, user_id: int) -> models.UserUsage:
+    """
+    The user's counters. Creates (and commits) the row if it's missing, so
+    call this before making other changes in the session.
+    """
+    usage = db.get(models.UserUsage, user_id)
+    if usage is not None:
+        return usage
+
+    db.add(_recount(db, user_id))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()  # another request created it first
+    return db.get(models.UserUsage, user_id)
+
+
+def has_room(usage: models.UserUsage, messages: int = 0, file_bytes: int = 0) -> bool:
+    """Cheap pre-check against already loaded counters."""
+    if USER_MESSAGE_QUOTA and usage.message_count + messages > USER_MESSAGE_QUOTA:
+        return False
+    if USER_STORAGE_QUOTA_BYTES and usage.file_bytes + file_bytes > USER_STORAGE_QUOTA_BYTES:
+        return False
+    return True
+
+
+def charge(db: Session, user_id: int, messages: int = 0, files: int = 0, file_bytes: int = 0) -> bool:
+    """
+    Add to the user's counters if that keeps them within quota, as a single
+    conditional UPDATE so concurrent requests can't both squeeze in.
+    Returns False (and changes nothing) when over quota.
+    """
+    query = db.query(models.UserUsage).filter(models.UserUsage.user_id == user_id)
+    if USER_MESSAGE_QUOTA and messages:
+        query = query.filter(models.UserUsage.message_count + messages <= USER_MESSAGE_QUOTA)
+    if USER_STORAGE_QUOTA_BYTES and file_bytes:
+        query = query.filter(models.UserUsage.file_bytes + file_bytes <= USER_STORAGE_QUOTA_BYTES)
+    return query.update(_deltas(messages, files, file_bytes), synchronize_session=False) == 1
+
+
+def release(db: Session, user_id: int, messages: int = 0, files: int = 0, file_bytes: int = 0):
+    """Subtract deleted rows from the user's counters, never going below zero."""
+    db.query(models.UserUsage).filter(models.UserUsage.user_id == user_id).update(
+        {
+            column: case((column < amount, 0), else_=column - amount)
+            for column, amount in (
+                (models.UserUsage.message_count, messages),
+                (models.UserUsage.file_count, files),
+                (models.UserUsage.file_bytes, file_bytes),
+            )
+        },
+        synchronize_session=False,
+    )
+
+
+def _deltas(messages: int, files: int, file_bytes: int) -> dict:
+    return {
+        models.UserUsage.message_count: models.UserUsage.message_count + messages,
+        models.UserUsage.file_count: models.UserUsage.file_count + files,
+        models.UserUsage.file_bytes: models.UserUsage.file_bytes + file_bytes,
+    }
+
+
+def snapshot(usage: models.UserUsage) -> dict:
+    return {
+        "message_count": usage.message_count,
+        "message_quota": USER_MESSAGE_QUOTA or None,
+        "file_count": usage.file_count,
+        "file_bytes": usage.file_bytes,
+        "file_bytes_quota": USER_STORAGE_QUOTA_BYTES or None,
+    }
+
+
+# ----------------- GLOBAL COUNTERS ----------------- #
+
+def increment(db: Session, name: str, by: int = 1):
+    """Bump a global counter. A missing row is left for users_count to initialize."""
+    db.query(models.Counter).filter(models.Counter.name == name).update(
+        {models.Counter.value: models.Counter.value + by}, synchronize_session=False
+    )
+
+
+def users_count(db: Session) -> int:
+    counter = db.get(models.Counter, USERS_COUNTER)
+    if counter is not None:
+        return counter.value
+
+    db.add(models.Counter(name=USERS_COUNTER, value=db.query(func.count(models.User.id)).scalar()))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+    return db.get(models.Counter, USERS_COUNTER).value
@@ -0,0 +1,200 @@
+# wire.py
+"""
+Frame encodings for the /ws endpoint.
+
+The encoding is negotiated with the Sec-WebSocket-Protocol header:
+- no subprotocol or "sandeshaa.json": JSON text frames, exactly what old
+  clients already speak. Ciphertext is the client's string.
+- "sandeshaa.msgpack": MessagePack binary frames. Ciphertext travels as raw
+  bytes in the packed form from ciphertext.py (no base64, no JSON escaping).
+
+Inside the server ciphertext is always packed bytes, the same form stored in
+the messages table, so MessagePack frames pass it through untouched and only
+JSON frames convert at the edge.
+
+permessage-deflate for either encoding is negotiated by uvicorn itself
+(`--ws-per-message-deflate`, on by default), so nothing is needed here.
+
+A payload going to many sockets can be wrapped in a Frame, which encodes
+once per codec and reuses the result. Frame.with_fields() adds a few
+per-recipient fields (group messages: shared body, one key per member); for
+JSON they are spliced onto the already encoded frame instead of re-encoding
+the whole payload, which is where the per-socket cost went.
+"""
+from typing import Any, Dict, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+import ciphertext as ct
+import fastjson
+
+try:
+    import msgpack
+except ImportError:  # optional: without it only JSON framing is offered
+    msgpack = None
+
+JSON_SUBPROTOCOL = "sandeshaa.json"
+MSGPACK_SUBPROTOCOL = "sandeshaa.msgpack"
+
+
+class JsonCodec:
+    """JSON text frames (default, backwards compatible)."""
+
+    subprotocol = JSON_SUBPROTOCOL
+    binary = False
+
+    def encode(self, payload: Dict[str, Any]) -> str:
+        if isinstance(payload.get("ciphertext"), bytes):
+            payload = {**payload, "ciphertext": ct.unpack(payload["ciphertext"])}
+        return fastjson.dumps_str(payload)
+
+    def extend(self, encoded: str, fields: Dict[str, Any]) -> str:
+        """
+        Add fields to an encoded object without re-encoding the rest. The
+        keys must not already be in it (JSON would carry both).
+        """
+        if not fields:
+            return encoded
+        extra = fastjson.dumps_str(fields)
+        if encoded == "{}":
+            return extra
+        return f"{encoded[:-1]},{extra[1:]}"
+
+    def decode(self, raw: str) -> Dict[str, Any]:
+        data = fastjson.loads(raw)
+        if not isinstance(data, dict):
+            raise ValueError("Frame must be an object")
+        if isinstance(data.get("ciphertext"), str) and data["ciphertext"]:
+            data["ciphertext"] = ct.pack(data["ciphertext"])
+        return data
+
+
+class MsgpackCodec:
+    """MessagePack binary frames with ciphertext as raw bytes."""
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def encode(self, payload: Dict[str, Any]) -> bytes:
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, raw: bytes) -> Dict[str, Any]:
+        data = msgpack.unpackb(raw, raw=False)
+        if not isinstance(data, dict):
+            raise ValueError("Frame must be a map")
+        if isinstance(data.get("ciphertext"), bytes):
+            data["ciphertext"] = ct.check(data["ciphertext"])
+        elif isinstance(data.get("ciphertext"), str) and data["ciphertext"]:
+            data["ciphertext"] = ct.pack(data["ciphertext"])
+        return data
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+
+class Frame:
+    """A payload sent to several sockets, encoded at most once per codec."""
+
+    def __init__(self, payload: Dict[str, Any]):
+        self.payload = payload
+        self._encoded = {}
+
+    def encode(self, codec):
+        data = self._encoded.get(codec.subprotocol)
+        if data is None:
+            data = self._encoded[codec.subprotocol] = codec.encode(self.payload)
+        return data
+
+    def with_fields(self, **fields) -> "ExtendedFrame":
+        """This frame plus fields it doesn't already have (they're appended, not replaced)."""
+        overlap = fields.keys() & self.payload.keys()
+        if overlap:
+            raise ValueError(f"Fields already in the frame: {', '.join(sorted(overlap))}")
+        return ExtendedFrame(self, fields)
+
+
+class ExtendedFrame:
+    """A shared Frame plus a few fields of its own, spliced in when sent."""
+
+    def __init__(self, base: Frame, fields: Dict[str, Any]):
+        self.base = base
+        self.fields = fields
+
+    def encode(self, codec):
+        extend = getattr(codec, "extend", None)
+        if extend is None:
+            # msgpack packs a whole frame about as fast as it could be spliced
+            return codec.encode({**self.base.payload, **self.fields})
+        return extend(self.base.encode(codec), self.fields)
+
+
+class FrameTooLarge(ValueError):
+    """An inbound frame over the connection's size limit (not decoded)."""
+
+
+def _too_large(raw, max_bytes: int) -> bool:
+    if isinstance(raw, bytes):
+        return len(raw) > max_bytes
+    # Text: one to four bytes per character; only encode when it matters
+    if len(raw) > max_bytes:
+        return True
+    if len(raw) * 4 <= max_bytes:
+        return False
+    return len(raw.encode("utf-8")) > max_bytes
+
+
+def negotiate(offered: list[str]):
+    """Pick the codec for a socket from the subprotocols the client offered."""
+    if MSGPACK_SUBPROTOCOL in offered and MSGPACK_CODEC is not None:
+        return MSGPACK_CODEC
+    return JSON_CODEC
+
+
+class Connection:
+    """An accepted /ws socket together with the codec used for its frames."""
+
+    def __init__(self, websocket: WebSocket, codec, max_frame_bytes: int = 0):
+        self.websocket = websocket
+        self.codec = codec
+        self.max_frame_bytes = max_frame_bytes
+
+    async def send(self, payload: Union[Dict[str, Any], Frame, ExtendedFrame]):
+        if isinstance(payload, dict):
+            data = self.codec.encode(payload)
+        else:
+            data = payload.encode(self.codec)
+        if self.codec.binary:
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.send_text(data)
+
+    async def receive(self) -> Dict[str, Any]:
+        """
+        Next frame as a dict. Raises ValueError on a malformed frame or one
+        of the wrong kind (text on a msgpack socket, binary on a JSON one),
+        FrameTooLarge (before decoding) on one over max_frame_bytes, and
+        WebSocketDisconnect when the client goes away.
+        """
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        raw = message.get("bytes" if self.codec.binary else "text")
+        if raw is None:
+            raise ValueError("wrong frame type")
+        if self.max_frame_bytes and _too_large(raw, self.max_frame_bytes):
+            raise FrameTooLarge(f"Frame too large (max {self.max_frame_bytes} bytes)")
+        return self.codec.decode(raw)
+
+    async def close(self):
+        await self.websocket.close()
+
+
+async def accept(websocket: WebSocket, max_frame_bytes: int = 0) -> Connection:
+    """Accept the handshake, answering with the negotiated subprotocol."""
+    offered = websocket.scope.get("subprotocols") or []
+    codec = negotiate(offered)
+    # Only echo a subprotocol the client asked for; plain clients get none
+    subprotocol = codec.subprotocol if codec.subprotocol in offered else None
+    await websocket.accept(subprotocol=subprotocol)
+    return Connection(websocket, codec, max_frame_bytes)
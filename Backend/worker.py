@@ -0,0 +1,39 @@
+# worker.py
+"""
+Optional standalone worker for scheduled cleanup.
+
+By default the API process runs the cleanup schedule on its own job queue.
+To keep that work off the API workers entirely, set RUN_CLEANUP_IN_API=false
+for the API and run this next to it:
+
+    python worker.py
+"""
+import asyncio
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from init_db import init_db
+from jobs import job_queue
+import tasks
+
+
+async def main():
+    init_db()
+    await job_queue.start()
+    scheduler = tasks.create_scheduler()
+    scheduler.start()
+    print("✅ Cleanup worker started (messages: 7 days, files: 24 hours)")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        scheduler.shutdown()
+        await job_queue.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
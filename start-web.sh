@@ -8,7 +8,7 @@ echo "🚀 Starting Sandeshaa Web App..."
 echo "📡 Starting Backend..."
 cd Backend
 source venv/bin/activate
-uvicorn main:app --reload --host 0.0.0.0 &
+uvicorn main:app --reload --host 0.0.0.0 --ws-max-size 524288 &
 BACKEND_PID=$!
 
 # Start Frontend